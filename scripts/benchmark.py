@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"script for benchmarking the pipeline on synthetic data against stored baselines"
+
+import argparse
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import pandas as pd
+from cache import get_key
+from synthetic_data import make_derivatives, make_connectomes
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+# run in a fresh interpreter by bench_model_input, so that the memory of the benchmark process is not measured
+MODEL_INPUT = """
+import sys, json
+import numpy as np
+from fit_svm import get_model_input
+from profiling import enable, stage, collect
+
+enable()
+for _ in range(int(sys.argv[2])):
+    with stage('model_input'):
+        features, labels = get_model_input(sys.argv[1])
+        np.asarray(features).sum()
+print(json.dumps({'n_subjects' : len(labels), 'records' : collect()}))
+"""
+
+def run_script(script, *args):
+    """
+    Run a pipeline script in a subprocess, measuring its wall time and peak memory
+
+    Parameters
+    ----------
+    script (str): file name of script in the scripts directory
+    args: command line arguments of the script
+
+    Returns
+    ----------
+    wall_s (float): wall time of the script
+    peak_rss_mb (float): peak resident set size of the script process, pool workers excluded
+    """
+    # the child is reaped with wait4 to get its own resource usage, stderr going
+    # to a file so that a full pipe cannot block it
+
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(SCRIPTS, script), *map(str, args), '--verbosity', '0'], stdout=subprocess.DEVNULL, stderr=stderr)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        if process.returncode:
+            stderr.seek(0)
+            raise RuntimeError(f'{script} failed:\n{stderr.read().decode()}')
+
+    return wall, usage.ru_maxrss / 2**10
+
+def bench_connectivity(path, atlas, n_subjects, n_jobs = 1, chunk_size = None):
+    """
+    Time the extraction of connectomes of all subjects, ignoring cached outputs
+
+    Parameters
+    ----------
+    path (str): path to synthetic derivatives directory
+    atlas (str): path to atlas file
+    n_subjects (int): number of subjects in the derivatives directory
+    n_jobs (int): number of subjects processed concurrently
+    chunk_size (int): number of timepoints read at a time, None to load whole images
+
+    Returns
+    ----------
+    result (dict): wall time, throughput in subjects/s and peak memory
+    """
+    args = [path, atlas, '--force', '--n_jobs', n_jobs, *(['--chunk_size', chunk_size] if chunk_size else [])]
+    wall, peak = run_script('get_connectivity_data.py', *args)
+
+    return {'wall_s' : wall, 'throughput' : n_subjects / wall, 'unit' : 'subjects/s', 'peak_rss_mb' : peak}
+
+def bench_model_input(path, repeats = 5):
+    """
+    Time the loading of the feature matrix and labels of all subjects in a
+    subprocess, peak memory being that of the loads rather than of the benchmark
+
+    Parameters
+    ----------
+    path (str): path to synthetic derivatives directory
+    repeats (int): number of loads, the fastest being reported
+
+    Returns
+    ----------
+    result (dict): wall time, throughput in subjects/s and peak memory
+    """
+    process = subprocess.run([sys.executable, '-c', MODEL_INPUT, path, str(repeats)], cwd=SCRIPTS, capture_output=True, text=True)
+    if process.returncode:
+        raise RuntimeError(f'get_model_input failed:\n{process.stderr}')
+    output = json.loads(process.stdout.strip().splitlines()[-1])
+
+    wall = min(record['wall_s'] for record in output['records'])
+    return {'wall_s' : wall, 'throughput' : output['n_subjects'] / wall, 'unit' : 'subjects/s', 'peak_rss_mb' : max(record['peak_rss_mb'] for record in output['records'])}
+
+def bench_fit(path, results, search = 'grid', solver = 'libsvm', n_jobs = 1):
+    """
+    Time the hyperparameter search, refit and prediction of fit_svm
+
+    Parameters
+    ----------
+    path (str): path to synthetic derivatives directory
+    results (str): path to ml_metrics directory written by fit_svm
+    search (str): search strategy of fit_svm
+    solver (str): SVM solver of fit_svm
+    n_jobs (int): number of fits run in parallel
+
+    Returns
+    ----------
+    result (dict): wall time, throughput in model fits/s and peak memory
+    """
+    args = [path, '--seed', 0, '--search', search, '--solver', solver, '--n_jobs', n_jobs, '--file_suffix', '_benchmark']
+    wall, peak = run_script('fit_svm.py', *args)
+
+    # each candidate is fitted once per fold, plus one refit of the best candidate
+
+    history = pd.read_csv(os.path.join(results, 'svc_rest_search_history_benchmark.tsv'), sep='\t')
+    n_fits = len(history) * len([col for col in history.columns if col.startswith('split') and col.endswith('_test_score')]) + 1
+
+    return {'wall_s' : wall, 'throughput' : n_fits / wall, 'unit' : 'fits/s', 'peak_rss_mb' : peak}
+
+def compare(results, baseline, tolerance = 0.2, min_wall_s = 0.05, min_rss_mb = 5.):
+    """
+    Compare benchmark results to a baseline with the same configuration,
+    differences being regressions only when they exceed both the relative
+    tolerance and an absolute floor, so that noise of short benchmarks is ignored
+
+    Parameters
+    ----------
+    results (dict): results of each benchmark
+    baseline (dict): results of each benchmark in the baseline run
+    tolerance (float): relative slowdown or memory growth counted as a regression
+    min_wall_s (float): smallest slowdown in seconds counted as a regression
+    min_rss_mb (float): smallest memory growth in MB counted as a regression
+
+    Returns
+    ----------
+    comparison (pd.DataFrame): current and baseline values, ratios and regressions of each benchmark
+    """
+    rows = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        rows.append({
+            'benchmark' : name,
+            'wall_s' : result['wall_s'],
+            'baseline_wall_s' : base['wall_s'],
+            'speedup' : base['wall_s'] / result['wall_s'],
+            'peak_rss_mb' : result['peak_rss_mb'],
+            'baseline_peak_rss_mb' : base['peak_rss_mb'],
+            'regression' : (result['wall_s'] > (1 + tolerance) * base['wall_s'] and result['wall_s'] - base['wall_s'] > min_wall_s)
+                            or (result['peak_rss_mb'] > (1 + tolerance) * base['peak_rss_mb'] and result['peak_rss_mb'] - base['peak_rss_mb'] > min_rss_mb),
+            })
+
+    return pd.DataFrame(rows)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', type=str, nargs='+', choices=['connectivity', 'model_input', 'fit'], help='Benchmarks to run', default=['connectivity', 'model_input', 'fit'])
+    parser.add_argument('--n_subjects', type=int, help='Number of synthetic subjects with BOLD images', default=20)
+    parser.add_argument('--n_timepoints', type=int, help='Number of volumes per synthetic scan', default=150)
+    parser.add_argument('--shape', type=int, nargs=3, help='Dimensions of each synthetic volume', default=[40, 48, 40])
+    parser.add_argument('--n_regions', type=int, help='Number of synthetic atlas regions', default=64)
+    parser.add_argument('--n_connectomes', type=int, help='Number of synthetic subjects used by model benchmarks', default=400)
+    parser.add_argument('--n_jobs', type=int, help='Number of processes used by the benchmarked scripts', default=1)
+    parser.add_argument('--chunk_size', type=int, help='Number of timepoints read at a time by connectivity extraction', default=None)
+    parser.add_argument('--search', type=str, help='Search strategy of the fit benchmark', default='grid')
+    parser.add_argument('--solver', type=str, help='SVM solver of the fit benchmark', default='libsvm')
+    parser.add_argument('--work_dir', type=str, help='Directory for synthetic data, reused across runs with the same configuration, temporary by default', default=None)
+    parser.add_argument('--baselines', type=str, help='Path to JSON file of stored baselines', default=os.path.join(SCRIPTS, '..', 'results', 'benchmarks', 'baselines.json'))
+    parser.add_argument('--baseline_name', type=str, help='Name of baseline to compare to and save as', default='default')
+    parser.add_argument('--save_baseline', action='store_true', help='Store the results of this run as the baseline')
+    parser.add_argument('--tolerance', type=float, help='Relative slowdown or memory growth counted as a regression', default=0.2)
+    parser.add_argument('--min_wall_s', type=float, help='Smallest slowdown in seconds counted as a regression', default=0.05)
+    parser.add_argument('--min_rss_mb', type=float, help='Smallest memory growth in MB counted as a regression', default=5.)
+    parser.add_argument('--seed', type=int, help='Seed of synthetic data', default=0)
+    parser.add_argument('--verbosity', type=int, default=1)
+    args = parser.parse_args()
+
+    config = {k : v for k, v in vars(args).items() if k in ['n_subjects', 'n_timepoints', 'shape', 'n_regions', 'n_connectomes', 'n_jobs', 'chunk_size', 'search', 'solver', 'seed']}
+    work_dir = args.work_dir or tempfile.mkdtemp()
+    config_dir = os.path.join(work_dir, get_key(config)[:16])
+
+    # synthetic derivatives are laid out as <root>/data/derivatives so that fit_svm writes to <root>/results
+
+    images = os.path.join(config_dir, 'images', 'data', 'derivatives')
+    connectomes = os.path.join(config_dir, 'connectomes', 'data', 'derivatives')
+    results = {}
+
+    if 'connectivity' in args.benchmarks:
+        atlas = os.path.join(images, 'atlas.nii.gz')
+        if not(os.path.exists(atlas)):
+            if args.verbosity:
+                print(f'Generating {args.n_subjects} synthetic subjects with {args.n_timepoints} volumes of shape {args.shape}...')
+            make_derivatives(images, args.n_subjects, args.n_timepoints, tuple(args.shape), args.n_regions, args.seed)
+
+        if args.verbosity:
+            print('Benchmarking get_connectivity_data...')
+        results['connectivity'] = bench_connectivity(images, atlas, args.n_subjects, args.n_jobs, args.chunk_size)
+
+    if set(args.benchmarks) & {'model_input', 'fit'}:
+        if not(os.path.exists(os.path.join(connectomes, 'format_file.json'))):
+            if args.verbosity:
+                print(f'Generating {args.n_connectomes} synthetic connectomes of {args.n_regions} regions...')
+            make_connectomes(connectomes, args.n_connectomes, args.n_regions, args.seed)
+        os.makedirs(os.path.join(connectomes, '..', '..', 'results', 'ml_metrics'), exist_ok=True)
+
+    if 'model_input' in args.benchmarks:
+        if args.verbosity:
+            print('Benchmarking get_model_input...')
+        results['model_input'] = bench_model_input(connectomes)
+
+    if 'fit' in args.benchmarks:
+        if args.verbosity:
+            print(f'Benchmarking fit_svm {args.search} search with {args.solver}...')
+        results['fit'] = bench_fit(connectomes, os.path.join(connectomes, '..', '..', 'results', 'ml_metrics'), args.search, args.solver, args.n_jobs)
+
+    if not(args.work_dir):
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.verbosity:
+        print(pd.DataFrame(results).T.to_string())
+
+    # baselines are stored per name and only compared when their configuration matches
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, 'r') as o:
+            baselines = json.load(o)
+
+    baseline = baselines.get(args.baseline_name)
+    if baseline and baseline['config'] == config:
+        comparison = compare(results, baseline['results'], args.tolerance, args.min_wall_s, args.min_rss_mb)
+        if args.verbosity:
+            print(f'Comparison to baseline {args.baseline_name} ({baseline["date"]}):')
+            print(comparison.round(3).to_string(index=False))
+        if comparison['regression'].any():
+            print(f'Regressions found in {", ".join(comparison.loc[comparison["regression"], "benchmark"])}')
+            if not(args.save_baseline):
+                sys.exit(1)
+    elif baseline and args.verbosity:
+        print(f'Baseline {args.baseline_name} was recorded with a different configuration, not compared.')
+
+    if args.save_baseline:
+        baselines[args.baseline_name] = {'date' : time.strftime('%Y-%m-%d %H:%M:%S'), 'config' : config, 'results' : {**(baseline['results'] if baseline and baseline['config'] == config else {}), **results}}
+        os.makedirs(os.path.dirname(os.path.abspath(args.baselines)), exist_ok=True)
+        with open(args.baselines, 'w') as savefile:
+            json.dump(baselines, savefile, indent=4)
+        if args.verbosity:
+            print(f'Baseline {args.baseline_name} saved to {os.path.abspath(args.baselines)}')
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"functions for content-addressed caching of derived files"
+
+import os
+import fcntl
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = [
+'get_key',
+'file_digest',
+'get_digests',
+'load_manifest',
+'save_manifest',
+'is_current',
+'set_current'
+]
+
+def get_key(*parts):
+    """
+    Hash JSON serializable parts into a single cache key
+
+    Parameters
+    ----------
+    parts: values identifying a derived output (digests, parameters, ...)
+
+    Returns
+    ----------
+    key (str): sha256 hex digest of the parts
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def file_digest(path, record = None, block_size = 2**20):
+    """
+    Get the sha256 digest of a file, reusing a previous digest when the size
+    and modification time of the file are unchanged
+
+    Parameters
+    ----------
+    path (str): path to file
+    record (dict): previous record of the file, as returned by this function
+    block_size (int): number of bytes read at a time
+
+    Returns
+    ----------
+    record (dict): size, modification time and sha256 digest of the file
+    """
+    stat = os.stat(path)
+    if record and record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+        return record
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as o:
+        for block in iter(lambda: o.read(block_size), b''):
+            sha.update(block)
+
+    return {'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns, 'sha256' : sha.hexdigest()}
+
+def get_digests(paths, manifest, n_jobs = 1):
+    """
+    Get digests of several files, updating the file records of a manifest,
+    files which do not exist are left out
+
+    Parameters
+    ----------
+    paths (list): paths to files
+    manifest (dict): manifest as returned by load_manifest
+    n_jobs (int): number of files to hash concurrently
+
+    Returns
+    ----------
+    digests (dict): sha256 digest of each file
+    """
+    paths = sorted(set(os.path.abspath(path) for path in paths if os.path.exists(path)))
+    records = manifest['files']
+
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        for path, record in zip(paths, executor.map(lambda p: file_digest(p, records.get(p)), paths)):
+            records[path] = record
+
+    return {path : records[path]['sha256'] for path in paths}
+
+def load_manifest(path):
+    """
+    Load a cache manifest, or create an empty one
+
+    Parameters
+    ----------
+    path (str): path to manifest JSON file
+
+    Returns
+    ----------
+    manifest (dict): records of input files and keys of outputs, outputs
+    being named relative to the directory of the manifest
+    """
+    manifest = {'files' : {}, 'outputs' : {}}
+    if os.path.exists(path):
+        with open(path, 'r') as o:
+            manifest = json.load(o)
+    manifest['root'] = os.path.dirname(os.path.abspath(path))
+    manifest['loaded'] = {section : dict(manifest[section]) for section in ['files', 'outputs']}
+
+    return manifest
+
+def save_manifest(manifest, path):
+    """
+    Atomically save a cache manifest, records changed since it was loaded
+    being merged into the file so that processes sharing a manifest keep
+    each other's records
+
+    Parameters
+    ----------
+    manifest (dict): manifest as returned by load_manifest
+    path (str): path to manifest JSON file
+    """
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        saved = load_manifest(path)
+        for section in ['files', 'outputs']:
+            loaded = manifest.get('loaded', {}).get(section, {})
+            saved[section].update({k : v for k, v in manifest[section].items() if loaded.get(k) != v})
+            manifest[section] = saved[section]
+            manifest['loaded'] = {**manifest.get('loaded', {}), section : dict(saved[section])}
+
+        with open(f'{path}.tmp', 'w') as savefile:
+            json.dump({section : manifest[section] for section in ['files', 'outputs']}, savefile)
+        os.replace(f'{path}.tmp', path)
+
+def is_current(manifest, output, key):
+    """
+    Check whether an output exists and was derived from inputs matching a key
+
+    Parameters
+    ----------
+    manifest (dict): manifest as returned by load_manifest
+    output (str): path to output file
+    key (str): cache key of the inputs of the output
+
+    Returns
+    ----------
+    current (bool): whether the output is up to date
+    """
+    return key is not None and manifest['outputs'].get(os.path.relpath(output, manifest['root'])) == key and os.path.exists(output)
+
+def set_current(manifest, output, key):
+    """
+    Record the cache key of the inputs an output was derived from
+
+    Parameters
+    ----------
+    manifest (dict): manifest as returned by load_manifest
+    output (str): path to output file
+    key (str): cache key of the inputs of the output
+    """
+    manifest['outputs'][os.path.relpath(output, manifest['root'])] = key
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"functions for computing connectivity features of many subjects as batched array operations"
+
+import numpy as np
+
+__all__ = [
+'KINDS',
+'GROUP_KINDS',
+'pad_time_series',
+'ledoit_wolf_covariances',
+'geometric_mean',
+'vectorize',
+'unvectorize',
+'SquareView',
+'compute_connectivity'
+]
+
+KINDS = ['covariance', 'correlation', 'partial correlation', 'precision', 'tangent']
+
+# kinds whose features depend on the whole group rather than on single subjects
+GROUP_KINDS = ['tangent']
+
+def pad_time_series(time_series):
+    """
+    Center the time series of several subjects and stack them into a zero
+    padded batch, padded timepoints contributing nothing to sums of products
+
+    Parameters
+    ----------
+    time_series (list): time series of each subject, timepoints x regions
+
+    Returns
+    ----------
+    batch (np.array): centered time series, subjects x timepoints x regions
+    lengths (np.array): number of timepoints of each subject
+    """
+    lengths = np.asarray([len(ts) for ts in time_series])
+    batch = np.zeros((len(time_series), lengths.max(), time_series[0].shape[1]))
+    for k, ts in enumerate(time_series):
+        batch[k, :lengths[k]] = ts - ts.mean(axis=0)
+
+    return batch, lengths
+
+def ledoit_wolf_covariances(time_series):
+    """
+    Estimate the Ledoit-Wolf shrunk covariance of each subject, as done by
+    sklearn's LedoitWolf, the default estimator of nilearn's ConnectivityMeasure
+
+    Parameters
+    ----------
+    time_series (list): time series of each subject, timepoints x regions
+
+    Returns
+    ----------
+    covariances (np.array): shrunk covariances, subjects x regions x regions
+    """
+    batch, lengths = pad_time_series(time_series)
+    n = lengths[:, None, None].astype(float)
+    n_regions = batch.shape[-1]
+
+    products = np.einsum('sti,stj->sij', batch, batch)
+    squares = batch ** 2
+    emp_cov = products / n
+    mu = np.trace(emp_cov, axis1=1, axis2=2) / n_regions
+
+    # shrinkage intensity, following sklearn.covariance.ledoit_wolf_shrinkage
+
+    beta = np.einsum('sti,stj->s', squares, squares)
+    delta = np.einsum('sij,sij->s', products, products) / lengths ** 2
+    beta = (beta / lengths - delta) / (n_regions * lengths)
+    delta = (delta - 2. * mu * squares.sum(axis=(1, 2)) / lengths + n_regions * mu ** 2) / n_regions
+    shrinkage = np.where(beta == 0, 0., np.minimum(beta, delta) / np.where(delta == 0, 1., delta))
+
+    covariances = (1. - shrinkage)[:, None, None] * emp_cov
+    covariances[:, np.arange(n_regions), np.arange(n_regions)] += (shrinkage * mu)[:, None]
+
+    return covariances
+
+def map_eigenvalues(function, matrices):
+    """
+    Apply a function to the eigenvalues of a batch of symmetric matrices
+
+    Parameters
+    ----------
+    function (callable): function applied to eigenvalues
+    matrices (np.array): symmetric matrices, (batch x) regions x regions
+
+    Returns
+    ----------
+    matrices (np.array): symmetric matrices with mapped eigenvalues
+    """
+    vals, vecs = np.linalg.eigh(matrices)
+    return (vecs * function(vals)[..., None, :]) @ np.swapaxes(vecs, -1, -2)
+
+def geometric_mean(matrices, max_iter = 10, tol = 1e-7):
+    """
+    Compute the geometric mean of symmetric positive definite matrices by
+    gradient descent, as done by nilearn for the tangent space reference
+
+    Parameters
+    ----------
+    matrices (np.array): positive definite matrices, subjects x regions x regions
+    max_iter (int): maximum number of gradient descent iterations
+    tol (float): gradient norm at which descent stops
+
+    Returns
+    ----------
+    gmean (np.array): geometric mean, regions x regions
+    """
+    gmean = matrices.mean(axis=0)
+    norm_old = np.inf
+    step = 1.
+
+    for _ in range(max_iter):
+        vals, vecs = np.linalg.eigh(gmean)
+        inv_sqrt = (vecs / np.sqrt(vals)) @ vecs.T
+        logs_mean = map_eigenvalues(np.log, inv_sqrt @ matrices @ inv_sqrt).mean(axis=0)
+        if np.any(np.isnan(logs_mean)):
+            raise FloatingPointError('Nan value after logarithm operation.')
+
+        sqrt = (vecs * np.sqrt(vals)) @ vecs.T
+        gmean = sqrt @ map_eigenvalues(lambda x: np.exp(x * step), logs_mean) @ sqrt
+
+        # halve the step whenever the gradient norm increases
+
+        norm = np.linalg.norm(logs_mean)
+        if norm < norm_old:
+            norm_old = norm
+        elif norm > norm_old:
+            step = step / 2.
+            norm = norm_old
+        if tol is not None and norm / gmean.size < tol:
+            break
+
+    return gmean
+
+def cov_to_corr(covariances):
+    """
+    Convert a batch of covariance matrices to correlation matrices
+
+    Parameters
+    ----------
+    covariances (np.array): covariances, (batch x) regions x regions
+
+    Returns
+    ----------
+    correlations (np.array): correlations with a unit diagonal
+    """
+    scale = 1. / np.sqrt(np.diagonal(covariances, axis1=-2, axis2=-1))
+    correlations = covariances * scale[..., :, None] * scale[..., None, :]
+    n_regions = correlations.shape[-1]
+    correlations[..., np.arange(n_regions), np.arange(n_regions)] = 1.
+
+    return correlations
+
+def vectorize(matrices):
+    """
+    Flatten the strict lower triangle of a batch of symmetric matrices, in
+    the order of nilearn's sym_matrix_to_vec with discard_diagonal=True
+
+    Parameters
+    ----------
+    matrices (np.array): symmetric matrices, (batch x) regions x regions
+
+    Returns
+    ----------
+    vectors (np.array): off-diagonal values, (batch x) edges
+    """
+    return matrices[..., np.tril(np.ones(matrices.shape[-2:], dtype=bool), k=-1)]
+
+def unvectorize(vectors, diagonal = 0.):
+    """
+    Rebuild symmetric matrices from their strict lower triangle, as flattened by vectorize
+
+    Parameters
+    ----------
+    vectors (np.array): off-diagonal values, (batch x) edges
+    diagonal (float): value of the diagonal
+
+    Returns
+    ----------
+    matrices (np.array): symmetric matrices, (batch x) regions x regions
+    """
+    vectors = np.asarray(vectors)
+    n_regions = int(round((1 + np.sqrt(1 + 8 * vectors.shape[-1])) / 2))
+    if n_regions * (n_regions - 1) // 2 != vectors.shape[-1]:
+        raise ValueError(f'{vectors.shape[-1]} values do not form the lower triangle of a square matrix')
+
+    lower = np.tril(np.ones((n_regions, n_regions), dtype=bool), k=-1)
+    matrices = np.full((*vectors.shape[:-1], n_regions, n_regions), diagonal, dtype=vectors.dtype)
+    matrices[..., lower] = vectors
+    matrices[..., lower.T] = np.swapaxes(matrices, -1, -2)[..., lower.T]
+
+    return matrices
+
+class SquareView:
+    """
+    Read-only sequence of square matrices over a stack of vectorized
+    connectomes, each matrix being built only when it is indexed
+
+    Parameters
+    ----------
+    vectors (np.array): off-diagonal values, n x edges, e.g. a memory-mapped feature store
+    diagonal (float): value of the diagonal
+    """
+
+    def __init__(self, vectors, diagonal = 0.):
+        self.vectors = vectors
+        self.diagonal = diagonal
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __getitem__(self, idx):
+        return unvectorize(self.vectors[idx], self.diagonal)
+
+def compute_connectivity(time_series, kind = 'correlation', batch_size = 256):
+    """
+    Compute the vectorized connectivity of a group of subjects, covariances
+    of each batch of subjects being estimated with stacked array operations
+    and group level references, as the tangent space mean, being fitted once
+
+    Parameters
+    ----------
+    time_series (list): time series of each subject, timepoints x regions
+    kind (str): connectivity kind, one of KINDS
+    batch_size (int): number of subjects whose covariances are estimated at a time
+
+    Returns
+    ----------
+    features (np.array): connectivity features, subjects x edges
+    """
+    if kind not in KINDS:
+        raise ValueError(f'Unknown connectivity kind {kind}, expected one of {KINDS}')
+
+    batches = [ledoit_wolf_covariances(time_series[i:i + batch_size]) for i in range(0, len(time_series), batch_size)]
+
+    if kind == 'tangent':
+        covariances = np.concatenate(batches)
+        if len(covariances) < 2:
+            raise ValueError('Tangent space parametrization can only be applied to a group of subjects')
+        whitening = map_eigenvalues(lambda x: 1. / np.sqrt(x), geometric_mean(covariances))
+        return vectorize(map_eigenvalues(np.log, whitening @ covariances @ whitening))
+
+    features = []
+    for covariances in batches:
+        if kind == 'correlation':
+            covariances = cov_to_corr(covariances)
+        elif kind == 'partial correlation':
+            covariances = -cov_to_corr(np.linalg.inv(covariances))
+        elif kind == 'precision':
+            covariances = np.linalg.inv(covariances)
+        features.append(vectorize(covariances))
+
+    return np.concatenate(features)
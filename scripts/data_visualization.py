@@ -1,166 +1,370 @@
 "script for producing all plots shown in README.md file"
 
+import argparse
 
 import os
+import sys
+import glob
 import json
+import traceback
 import numpy as np
 import pandas as pd
-from scipy.spatial.distance import squareform
-from itertools import combinations as cb
+import nibabel as nib
+import matplotlib
+matplotlib.use('Agg')
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.utils import Bunch
 from nilearn import datasets, plotting
 from nilearn.maskers import NiftiLabelsMasker
-from nilearn.connectome import ConnectivityMeasure
 from nilearn.interfaces.fmriprep import load_confounds_strategy
 import matplotlib.pyplot as plt
 import seaborn as sns
-from format_data import load_data
-
-if __name__ == '__main__':
-
-    lab_names = {'CONTROL' : 'Control', 'BIPOLAR' : 'Bipolar', 'ADHD' : 'ADHD', 'SCHZ' : 'Schizophrenia'}
-
-    data = load_data('data/derivatives')
-
-    # get dataset summary statistics
-
-    phen = pd.DataFrame(data.phenotypic, columns=['Subject', 'Diagnosis', 'Age', 'Sex']).set_index('Subject')
+from format_data import load_data, INDEX_FILE
+from feature_store import get_store_paths, load_feature_store, read_features, decode_features
+from connectivity import unvectorize
+from interpretation import load_weights, get_pair_names, interpret_weights
+from cache import get_key, get_digests, load_manifest, save_manifest, is_current, set_current
+from get_connectivity_data import get_confound_paths
+from profiling import enable, stage, collect, extend, write_profile
+
+# per-process state shared by all figures, set up once by init_renderer
+_shared = {}
+
+def init_renderer(shared, profile = False):
+    """
+    Initialize the computations shared between figures in the current process
+
+    Parameters
+    ----------
+    shared (dict): shared values, as returned by get_shared
+    profile (bool): whether rendering of each figure is measured
+    """
+    enable(profile)
+    _shared.update(shared)
+
+def get_shared(names, paths):
+    """
+    Compute the values shared between figures, each only once and only if a
+    figure to be rendered needs it
+
+    Parameters
+    ----------
+    names (set): names of shared values to compute
+    paths (Bunch): paths to data, atlas, results and figures, and atlas namespace
+
+    Returns
+    ----------
+    shared (dict): shared values
+    """
+    shared = {'paths' : paths}
+
+    if 'phen' in names:
+        data = load_data(paths.data)
+        shared['phen'] = pd.DataFrame({'Diagnosis' : np.asarray(data.diagnosis, dtype=str), 'Age' : data.age, 'Sex' : np.asarray(data.gender, dtype=str)}, index=pd.Index(data.order, name='Subject'))
+
+    if names & {'labels', 'pair_matrices', 'pair_images'}:
+        labels = np.unique(np.asarray(nib.load(paths.atlas).dataobj))
+        shared['labels'] = labels[labels != 0].tolist()
+
+    if 'coords' in names:
+        shared['coords'] = plotting.find_parcellation_cut_coords(paths.atlas)
+
+    # node strength maps of all pairs are computed in one pass, weight matrices
+    # being shared as a lazy view that each figure indexes for its own pair
+
+    if names & {'pair_matrices', 'pair_images'}:
+        interpretation = interpret_weights(paths.weights, paths.atlas)
+        shared['pair_matrices'] = interpretation.matrices
+        shared['pair_images'] = [interpretation.images.slicer[:, :, :, idx] for idx in range(len(interpretation.pairs))]
+
+    return shared
+
+def plot_summary_statistics(outputs):
+    phen = _shared['phen']
+    age = phen['Age'].to_numpy()
     summary = pd.DataFrame({
                 'Participants' : [*phen['Diagnosis'].value_counts().tolist(), phen['Diagnosis'].count()],
                 'Male' : [*phen[phen['Sex'] == 'M']['Diagnosis'].value_counts().tolist(), phen['Sex'].value_counts()['M']],
                 'Female' : [*phen[phen['Sex'] == 'F']['Diagnosis'].value_counts().tolist(), phen['Sex'].value_counts()['F']],
-                'Age Avg' : [*[round(np.mean([int(a) for a in phen[phen['Diagnosis'] == dis]['Age']]), 2) for dis in np.unique(phen['Diagnosis'])], round(np.mean([int(a) for a  in phen['Age']]), 2)],
-                'Age Std' : [*[round(np.std([int(a) for a in phen[phen['Diagnosis'] == dis]['Age']]), 2) for dis in np.unique(phen['Diagnosis'])], round(np.std([int(a) for a  in phen['Age']]), 2)]
+                'Age Avg' : [*[round(np.mean(age[phen['Diagnosis'] == dis]), 2) for dis in np.unique(phen['Diagnosis'])], round(np.mean(age), 2)],
+                'Age Std' : [*[round(np.std(age[phen['Diagnosis'] == dis]), 2) for dis in np.unique(phen['Diagnosis'])], round(np.std(age), 2)]
                 }, index =[ 'Control', 'Schizophrenia', 'Bipolar', 'ADHD', 'Total'] )
 
-    summary.to_csv('results/plots/summary_statistics.tsv', sep = '\t')
-
-    # plot phenotype distributions
+    summary.to_csv(outputs[0], sep = '\t')
 
-    phen['Age'] = [int(a) for a in phen['Age']]
-    plot = sns.violinplot(x='Diagnosis', y='Age', hue='Sex', data=phen)
+def plot_data_distribution(outputs):
+    plot = sns.violinplot(x='Diagnosis', y='Age', hue='Sex', data=_shared['phen'])
     plot.set_xticklabels(['Control', 'Schizophrenia', 'Bipolar', 'ADHD'])
-    plot.get_figure().savefig('results/plots/data_distribution.svg', format='svg')
-    plt.clf()
-
-    # plot atlas used in masking
+    plot.get_figure().savefig(outputs[0], format='svg')
 
-    atlas = datasets.fetch_atlas_basc_multiscale_2015()
-    plotting.plot_roi(atlas['scale064'], draw_cross=False)
-    plt.savefig('results/plots/atlas_rois.svg', format='svg')
+def plot_atlas_rois(outputs):
+    plotting.plot_roi(_shared['paths'].atlas, draw_cross=False)
+    plt.savefig(outputs[0], format='svg')
     plt.clf()
 
-    view = plotting.view_img(atlas['scale064'])
-    view.save_as_html('results/plots/atlas_rois.html')
-    plt.clf()
-
-
-    # plot some fMRI timeseries
+    view = plotting.view_img(_shared['paths'].atlas)
+    view.save_as_html(outputs[1])
 
-    img = data.func[0][0]
+def plot_timeseries(outputs, img):
     conf, sample_mask = load_confounds_strategy(img, denoise_strategy = 'simple', motion = 'basic', global_signal = 'basic')
-    masker = NiftiLabelsMasker(labels_img=atlas['scale064'], standardize=True)
+    masker = NiftiLabelsMasker(labels_img=_shared['paths'].atlas, standardize=True)
     masked_data = masker.fit_transform(img, confounds=conf, sample_mask=sample_mask)
     plt.plot(masked_data[0])
-    plt.savefig('results/plots/single_timeseries.svg', format='svg')
+    plt.savefig(outputs[0], format='svg')
     plt.clf()
     plt.plot(masked_data)
-    plt.savefig('results/plots/all_timeseries.svg', format='svg')
-    plt.clf()
+    plt.savefig(outputs[1], format='svg')
 
-    # plot connectivity matrix
+def plot_connectivity_matrix(outputs, connectome):
+    matrix = decode_features(np.load(connectome))
+    plotting.plot_matrix(unvectorize(matrix), vmin = -1, vmax = 1, labels=_shared['labels'])
+    plt.savefig(outputs[0], format='svg')
 
-    matrix = np.load(os.path.join('data/derivatives/connectomes', os.listdir('data/derivatives/connectomes')[0]))
-    plotting.plot_matrix(squareform(matrix), vmin = -1, vmax = 1, labels=masker.labels_)
-    plt.savefig('results/plots/connectivity_matrix.svg', format='svg')
-    plt.clf()
-
-    # plot feature matrix
-
-    matrices = np.asarray([np.load(os.path.join('data/derivatives/connectomes', mat)) for mat in os.listdir('data/derivatives/connectomes')])
+def plot_feature_matrix(outputs):
+    matrices = read_features(load_feature_store(_shared['paths'].data, 'rest', _shared['paths'].namespace))
     plt.imshow(matrices, aspect='auto')
     plt.colorbar()
     plt.title('feature matrix')
     plt.xlabel('features')
     plt.ylabel('subjects')
-    plt.savefig('results/plots/feature_matrix.svg', format='svg')
+    plt.savefig(outputs[0], format='svg')
+
+def plot_search_history(outputs, history):
+    history = pd.read_csv(history, sep='\t')
+    train_score = history[history['param_svc__kernel'] == 'linear']['mean_train_score'].tolist()
+    val_score = history[history['param_svc__kernel'] == 'linear']['mean_test_score'].tolist()
+    C_val = history[history['param_svc__kernel'] == 'linear']['param_svc__C'].tolist()
+
+    plt.figure(figsize=(12,8))
+    plt.plot(np.log10(C_val), train_score, label = 'Average Training Score')
+    plt.plot(np.log10(C_val), val_score, label = 'Average Validation Score')
+    plt.ylabel('Accuracy')
+    plt.xlabel('C Value (log10)')
+    plt.legend()
+    plt.title('Cross-Validation Accuracy as a Function of Regularizer C')
+    plt.savefig(outputs[0], format='svg')
+
+def plot_confusion_matrix(outputs, cmat):
+    cmat = pd.read_csv(cmat, sep='\t', index_col=0)
+    plt.matshow(cmat)
+    plt.tick_params(bottom=False)
+    plt.xticks([0,1,2,3],labels=['ADHD', 'Bipolar', 'Control', 'Schizophrenia'])
+    plt.yticks([0,1,2,3],labels=['ADHD', 'Bipolar', 'Control', 'Schizophrenia'], va='center', rotation=90)
+    for (x, y), value in np.ndenumerate(cmat.T):
+        plt.text(x, y, f"{value:.0f}", va="center", ha="center")
+    plt.savefig(outputs[0], format='svg')
+
+def plot_metrics(outputs, report):
+    with open(report, 'r') as o:
+        report = json.load(o)
+
+    metric_table = pd.DataFrame({k : m for k, m in report.items() if not(k=='accuracy')})
+    metric_table.to_csv(outputs[0], sep = '\t')
+
+def plot_pair_matrix(outputs, idx):
+    plotting.plot_matrix(_shared['pair_matrices'][idx], labels=_shared['labels'], tri='lower')
+    plt.savefig(outputs[0], format='svg')
+
+def plot_pair_connectome(outputs, idx):
+    plotting.plot_connectome(_shared['pair_matrices'][idx], _shared['coords'], edge_threshold= '98%')
+    plt.savefig(outputs[0], format='svg')
     plt.clf()
 
-    # plot model confusion matrix and metrics
-    # for both stratified control sample and full control sample
-
-    for suffix in ['', '_stratified']:
-
-        cmat = pd.read_csv(f'results/ml_metrics/svc_rest_confusion_matrix{suffix}.tsv', sep='\t', index_col=0)
-        history = pd.read_csv(f'results/ml_metrics/svc_rest_search_history{suffix}.tsv', sep='\t')
-        with open(f'results/ml_metrics/svc_rest_classification_report{suffix}.json', 'r') as o:
-            report = json.load(o)
+    view = plotting.view_connectome(_shared['pair_matrices'][idx], _shared['coords'], edge_threshold = '98%')
+    view.save_as_html(outputs[1])
+
+def plot_pair_image(outputs, idx):
+    view = plotting.view_img(_shared['pair_images'][idx], threshold = '90%')
+    view.save_as_html(outputs[0])
+
+def plot_pair_surface(outputs, idx):
+    view = plotting.view_img_on_surf(_shared['pair_images'][idx], threshold = '90%')
+    view.save_as_html(outputs[0])
+
+def get_targets(paths):
+    """
+    Get the figures that can be built, with the input files and shared
+    computations each depends on
+
+    Parameters
+    ----------
+    paths (Bunch): paths to data, atlas, results and figures, and atlas namespace
+
+    Returns
+    ----------
+    targets (list): one Bunch per figure with its name, render function,
+    parameters, input files, output files and shared values needed
+    """
+    plots = paths.plots
+    metrics = os.path.join(paths.results, 'ml_metrics')
+    index = os.path.join(paths.data, INDEX_FILE)
+
+    # file parameters of render functions are inputs of their target
+
+    def target(name, render, outputs, inputs = [], needs = [], **params):
+        files = [value for value in params.values() if isinstance(value, str)]
+        return Bunch(name = name, render = render, params = params, inputs = [*inputs, *files], outputs = [os.path.join(plots, out) for out in outputs], needs = needs)
+
+    targets = [
+        target('summary_statistics', plot_summary_statistics, ['summary_statistics.tsv'], [index], ['phen']),
+        target('data_distribution', plot_data_distribution, ['data_distribution.svg'], [index], ['phen']),
+        target('atlas_rois', plot_atlas_rois, ['atlas_rois.svg', 'atlas_rois.html'], [paths.atlas]),
+        target('feature_matrix', plot_feature_matrix, ['feature_matrix.svg'], [get_store_paths(paths.data, 'rest', paths.namespace)[0]]),
+    ]
+
+    data = load_data(paths.data)
+    if data.func and data.func[0]:
+        img = data.func[0][0]
+        targets.append(target('timeseries', plot_timeseries, ['single_timeseries.svg', 'all_timeseries.svg'], [paths.atlas, *get_confound_paths(img)], img = img))
+
+    connectomes = sorted(glob.glob(os.path.join(paths.data, 'connectomes', *([paths.namespace] if paths.namespace else []), 'sub-*_rest_connectome.npy')))
+    if connectomes:
+        targets.append(target('connectivity_matrix', plot_connectivity_matrix, ['connectivity_matrix.svg'], [paths.atlas], ['labels'], connectome = connectomes[0]))
+
+    # model figures for both stratified control sample and full control sample,
+    # or for the model of the atlas namespace, saved with its name as file suffix
+
+    for suffix in ([f'_{paths.namespace}'] if paths.namespace else ['', '_stratified']):
+        targets += [
+            target(f'search_history{suffix}', plot_search_history, [f'grid_search_history{suffix}.svg'], history = os.path.join(metrics, f'svc_rest_search_history{suffix}.tsv')),
+            target(f'confusion_matrix{suffix}', plot_confusion_matrix, [f'svc_cmatrix{suffix}.svg'], cmat = os.path.join(metrics, f'svc_rest_confusion_matrix{suffix}.tsv')),
+            target(f'metrics{suffix}', plot_metrics, [f'svc_metrics{suffix}.tsv'], report = os.path.join(metrics, f'svc_rest_classification_report{suffix}.json')),
+        ]
+
+    # svc weight figures, one per pair of classes
+
+    if os.path.exists(paths.weights):
+        for idx, (dis1, dis2) in enumerate(get_pair_names(load_weights(paths.weights)[1])):
+            inputs = [paths.weights, paths.atlas]
+            targets += [
+                target(f'{dis1}_vs_{dis2}_feature_matrix', plot_pair_matrix, [f'{dis1}_vs{dis2}_feature_matrix.svg'], inputs, ['labels', 'pair_matrices'], idx = idx),
+                target(f'{dis1}_vs_{dis2}_feature_connectome', plot_pair_connectome, [f'{dis1}_vs_{dis2}_feature_connectome.svg', f'{dis1}_vs_{dis2}_feature_connectome_interactive.html'], inputs, ['labels', 'pair_matrices', 'coords'], idx = idx),
+                target(f'{dis1}_vs_{dis2}_image', plot_pair_image, [f'{dis1}_vs_{dis2}_image_interactive.html'], inputs, ['pair_images'], idx = idx),
+                target(f'{dis1}_vs_{dis2}_3D', plot_pair_surface, [f'{dis1}_vs_{dis2}_3D_interactive.html'], inputs, ['pair_images'], idx = idx),
+            ]
+
+    return targets
+
+def build_target(target):
+    """
+    Render the figure of a target, any error being returned rather than
+    raised so that failures stay isolated to the figure
+
+    Parameters
+    ----------
+    target (Bunch): target, as returned by get_targets
+
+    Returns
+    ----------
+    name (str): name of target
+    error (str): traceback of failure, None on success
+    records (list): stage measurements of the figure, empty unless profiling
+    """
+    try:
+        with stage('plot', target=target.name):
+            target.render(target.outputs, **target.params)
+    except Exception:
+        return target.name, traceback.format_exc(), collect()
+    finally:
+        plt.close('all')
+
+    return target.name, None, collect()
 
-        # search history
-
-        train_score = history[history['param_svc__kernel'] == 'linear']['mean_train_score'].tolist()
-        val_score = history[history['param_svc__kernel'] == 'linear']['mean_test_score'].tolist()
-        C_val = val_std = history[history['param_svc__kernel'] == 'linear']['param_svc__C'].tolist()
-
-        plt.figure(figsize=(12,8))
-        plt.plot(np.log10(C_val), train_score, label = 'Average Training Score')
-        plt.plot(np.log10(C_val), val_score, label = 'Average Validation Score')
-        plt.ylabel('Accuracy')
-        plt.xlabel('C Value (log10)')
-        plt.legend()
-        plt.title('Cross-Validation Accuracy as a Function of Regularizer C')
-        plt.savefig(f'results/plots/grid_search_history{suffix}.svg', format='svg')
-        plt.clf()
-
-        # confusion matrix
-
-        plt.matshow(cmat)
-        plt.tick_params(bottom=False)
-        plt.xticks([0,1,2,3],labels=['ADHD', 'Bipolar', 'Control', 'Schizophrenia'])
-        plt.yticks([0,1,2,3],labels=['ADHD', 'Bipolar', 'Control', 'Schizophrenia'], va='center', rotation=90)
-        for (x, y), value in np.ndenumerate(cmat.T):
-            plt.text(x, y, f"{value:.0f}", va="center", ha="center")
-        plt.savefig(f'results/plots/svc_cmatrix{suffix}.svg', format='svg')
-        plt.clf()
-
-        # metrics
-
-        metric_table = pd.DataFrame({k : m for k, m in report.items() if not(k=='accuracy')})
-        metric_table.to_csv(f'results/plots/svc_metrics{suffix}.tsv', sep = '\t')
-
-    # plot svc weights
-
-    weights = np.load('results/svc_rest_weights.npy', allow_pickle=True)
-
-    correlation_measure = ConnectivityMeasure(kind = 'correlation', vectorize=True, discard_diagonal=True)
-    correlation_matrix = correlation_measure.fit_transform([masked_data])[0]
-    feat_exp_mat = correlation_measure.inverse_transform(weights[0])
-    inv_mask = masker.inverse_transform(weights[0])
-
-    idx = 0
-    for dis1, dis2 in cb([lab_names[lab] for lab in weights[1]], 2):
-
-        feat_vector = feat_exp_mat[idx]
-        inv_mask_vector = inv_mask.slicer[:,:,:,idx]
-
-        plotting.plot_matrix(feat_vector, labels=masker.labels_, tri='lower')
-        plt.savefig(f'results/plots/{dis1}_vs{dis2}_feature_matrix.svg', format='svg')
-        plt.clf()
-
-        coords = plotting.find_parcellation_cut_coords(atlas['scale064'])
-        plotting.plot_connectome(feat_vector, coords, edge_threshold= '98%')
-        plt.savefig(f'results/plots/{dis1}_vs_{dis2}_feature_connectome.svg', format='svg')
-        plt.clf()
-
-        view = plotting.view_connectome(feat_vector, coords, edge_threshold = '98%')
-        view.save_as_html(f'results/plots/{dis1}_vs_{dis2}_feature_connectome_interactive.html')
-        plt.clf()
-
-        view = plotting.view_img(inv_mask_vector, threshold = '90%')
-        view.save_as_html(f'results/plots/{dis1}_vs_{dis2}_image_interactive.html')
-        plt.clf()
-
-        view = plotting.view_img_on_surf(inv_mask_vector, threshold = '90%')
-        view.save_as_html(f'results/plots/{dis1}_vs_{dis2}_3D_interactive.html')
-        plt.clf()
+if __name__ == '__main__':
 
-        idx+=1
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, help='Path to derivatives directory or equivalent', default='data/derivatives')
+    parser.add_argument('--results', type=str, help='Path to results directory', default='results')
+    parser.add_argument('--atlas', type=str, help='Path to atlas file used in masking, the BASC 64 ROI atlas by default', default=None)
+    parser.add_argument('--namespace', type=str, help='Atlas namespace of connectivity data and models, when several atlases were extracted, figures are saved to plots/<namespace>', default=None)
+    parser.add_argument('--targets', type=str, nargs='+', help='Names of figures to build, all by default', default=None)
+    parser.add_argument('--n_jobs', type=int, help='Number of figures rendered concurrently, -1 to use all cores', default=1)
+    parser.add_argument('--force', action='store_true', help='Rebuild figures even if their inputs are unchanged')
+    parser.add_argument('--profile_dir', type=str, help='Directory to write stage timings, memory and reads of this run to', default=None)
+    parser.add_argument('--verbosity', type=int, default=1)
+    args = parser.parse_args()
+    enable(bool(args.profile_dir))
+
+    paths = Bunch(
+        data = os.path.abspath(args.path),
+        results = os.path.abspath(args.results),
+        atlas = os.path.abspath(args.atlas) if args.atlas else datasets.fetch_atlas_basc_multiscale_2015()['scale064'],
+        weights = os.path.join(os.path.abspath(args.results), f'svc_rest_weights{"_" + args.namespace if args.namespace else ""}.npy'),
+        plots = os.path.join(os.path.abspath(args.results), 'plots', *([args.namespace] if args.namespace else [])),
+        namespace = args.namespace,
+    )
+    os.makedirs(paths.plots, exist_ok=True)
+    n_jobs = os.cpu_count() if args.n_jobs == -1 else max(args.n_jobs, 1)
+
+    targets = get_targets(paths)
+    if args.targets:
+        targets = [target for target in targets if target.name in args.targets]
+
+    # figures are keyed on their parameters and the contents of their inputs and of this script,
+    # figures whose outputs were built from identical inputs are skipped
+
+    manifest_path = os.path.join(paths.plots, 'cache_manifest.json')
+    manifest = load_manifest(manifest_path)
+    digests = get_digests([__file__, *sum([target.inputs for target in targets], [])], manifest, n_jobs)
+
+    todo, missing = [], []
+    for target in targets:
+        if not(all(os.path.abspath(path) in digests for path in target.inputs)):
+            missing.append(target.name)
+            continue
+        target.key = get_key(target.name, target.params, [digests[os.path.abspath(path)] for path in [__file__, *target.inputs]])
+        if args.force or not(all(is_current(manifest, output, target.key) for output in target.outputs)):
+            todo.append(target)
+    save_manifest(manifest, manifest_path)
+
+    if args.verbosity:
+        print(f'{len(targets) - len(todo) - len(missing)} figures up to date, {len(missing)} missing inputs, building {len(todo)} using {n_jobs} process(es)...')
+    if args.verbosity > 1 and missing:
+        print(f'Missing inputs: {", ".join(missing)}')
+
+    with stage('shared'):
+        shared = get_shared(set(sum([target.needs for target in todo], [])), paths)
+    targets = {target.name : target for target in todo}
+
+    if n_jobs == 1:
+        init_renderer(shared, bool(args.profile_dir))
+        results = map(build_target, todo)
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_jobs, initializer=init_renderer, initargs=(shared, bool(args.profile_dir)))
+        results = as_completed([executor.submit(build_target, target) for target in todo])
+        results = (future.result() for future in results)
+
+    failed = []
+    for name, error, records in results:
+        extend(records)
+
+        if error is not None:
+            failed.append(name)
+            if args.verbosity:
+                print(f'Figure {name} failed:')
+                print(error)
+            continue
+
+        for output in targets[name].outputs:
+            set_current(manifest, output, targets[name].key)
+        save_manifest(manifest, manifest_path)
+
+        if args.verbosity > 1:
+            print(f'Figure {name} done.')
+
+    if n_jobs > 1:
+        executor.shutdown()
+
+    if args.verbosity:
+        print(f'{len(todo) - len(failed)} figures built, saved to {paths.plots}.')
+        if failed:
+            print(f'{len(failed)} figures failed: {", ".join(failed)}')
+
+    if args.profile_dir:
+        summary = write_profile(args.profile_dir, 'data_visualization', {'n_jobs' : n_jobs, 'n_figures' : len(todo)})
+        if args.verbosity:
+            print(f'Stage profile saved to {args.profile_dir}')
+            print(summary.round(3).to_string())
+
+    if failed:
+        sys.exit(1)
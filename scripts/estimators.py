@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+
+"estimators and search helpers for fitting linear SVMs on high-dimensional connectivity data"
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+from sklearn.svm import SVC, LinearSVC
+from sklearn.linear_model import SGDClassifier
+from sklearn.preprocessing import StandardScaler
+from sklearn.utils.validation import check_is_fitted
+from cache import get_key
+
+__all__ = [
+'PrimalSVC',
+'PrecomputedSVC',
+'apply_kernel',
+'back_project',
+'get_gram',
+'fit_c_path',
+'fit_gram_search'
+]
+
+class PrimalSVC(ClassifierMixin, BaseEstimator):
+    """
+    Linear support vector classifier solved in the primal with liblinear or
+    SGD, trained one-vs-one so that coef_ and classes_ follow the layout of
+    sklearn's SVC(kernel='linear')
+
+    Parameters
+    ----------
+    C (float): inverse regularization strength
+    solver (str): liblinear (LinearSVC) or sgd (SGDClassifier)
+    kernel (str): only linear, kept so parameter grids of SVC apply unchanged
+    max_iter (int): maximum number of solver iterations
+    tol (float): stopping tolerance of the solver
+    warm_start (bool): whether sgd refits start from the previous solution
+    random_state (int): seed of the solver
+    """
+    def __init__(self, C = 1.0, solver = 'liblinear', kernel = 'linear', max_iter = 1000, tol = 1e-4, warm_start = False, random_state = None):
+        self.C = C
+        self.solver = solver
+        self.kernel = kernel
+        self.max_iter = max_iter
+        self.tol = tol
+        self.warm_start = warm_start
+        self.random_state = random_state
+
+    def _get_binary_estimator(self, n_samples):
+        if self.solver == 'liblinear':
+            return LinearSVC(C = self.C, loss = 'hinge', dual = True, max_iter = self.max_iter, tol = self.tol, random_state = self.random_state)
+        elif self.solver == 'sgd':
+            return SGDClassifier(loss = 'hinge', alpha = 1. / (self.C * n_samples), max_iter = self.max_iter, tol = self.tol, warm_start = self.warm_start, random_state = self.random_state)
+
+        raise ValueError(f'Unknown solver {self.solver}')
+
+    def fit(self, X, y):
+        """
+        Fit one binary classifier per pair of classes
+
+        Parameters
+        ----------
+        X (np.array): features, subjects x features
+        y (np.array): class labels
+
+        Returns
+        ----------
+        self (PrimalSVC): fitted estimator
+        """
+        if self.kernel != 'linear':
+            raise ValueError(f'PrimalSVC only supports a linear kernel, got {self.kernel}')
+
+        X = np.asarray(X)
+        y = np.asarray(y)
+        classes = np.unique(y)
+        pairs = list(combinations(range(len(classes)), 2))
+
+        # warm starts reuse the pairwise estimators of the previous fit, updating only C
+
+        reuse = self.warm_start and hasattr(self, 'estimators_') and np.array_equal(classes, self.classes_)
+        if not(reuse):
+            self.estimators_ = [None] * len(pairs)
+
+        for k, (i, j) in enumerate(pairs):
+            keep = (y == classes[i]) | (y == classes[j])
+            if self.estimators_[k] is None:
+                self.estimators_[k] = self._get_binary_estimator(np.count_nonzero(keep))
+            else:
+                self.estimators_[k].set_params(**self._get_binary_estimator(np.count_nonzero(keep)).get_params())
+            self.estimators_[k].fit(X[keep], np.where(y[keep] == classes[i], 1, -1))
+
+        # as in libsvm, positive decisions of a pair favour its first class,
+        # binary problems are flipped so that positive decisions favour classes_[1]
+
+        sign = -1. if len(classes) == 2 else 1.
+        self.classes_ = classes
+        self.coef_ = sign * np.vstack([est.coef_ for est in self.estimators_])
+        self.intercept_ = sign * np.concatenate([est.intercept_ for est in self.estimators_])
+        self.n_features_in_ = X.shape[1]
+
+        return self
+
+    def decision_function(self, X):
+        """
+        Get decision values, aggregated one-vs-rest for multiclass problems as in SVC
+
+        Parameters
+        ----------
+        X (np.array): features, subjects x features
+
+        Returns
+        ----------
+        decision (np.array): subjects (x classes) decision values
+        """
+        check_is_fitted(self)
+        dec = np.asarray(X) @ self.coef_.T + self.intercept_
+        if len(self.classes_) == 2:
+            return dec.ravel()
+
+        votes = np.zeros((dec.shape[0], len(self.classes_)))
+        confidences = np.zeros_like(votes)
+        for k, (i, j) in enumerate(combinations(range(len(self.classes_)), 2)):
+            votes[:, i] += dec[:, k] > 0
+            votes[:, j] += dec[:, k] <= 0
+            confidences[:, i] += dec[:, k]
+            confidences[:, j] -= dec[:, k]
+
+        return votes + confidences / (3 * (np.abs(confidences) + 1))
+
+    def predict(self, X):
+        """
+        Predict class labels
+
+        Parameters
+        ----------
+        X (np.array): features, subjects x features
+
+        Returns
+        ----------
+        y (np.array): predicted class labels
+        """
+        dec = self.decision_function(X)
+        if dec.ndim == 1:
+            return self.classes_[(dec > 0).astype(int)]
+
+        return self.classes_[np.argmax(dec, axis=1)]
+
+def apply_kernel(gram, kernel = 'linear', gamma = 1., degree = 3, coef0 = 0., row_norms = None, col_norms = None):
+    """
+    Derive the kernels of sklearn's SVC from a linear Gram matrix
+
+    Parameters
+    ----------
+    gram (np.array): dot products between two sets of subjects, rows x columns
+    kernel (str): linear, poly, rbf or sigmoid
+    gamma (float): kernel coefficient of poly, rbf and sigmoid kernels
+    degree (int): degree of the poly kernel
+    coef0 (float): independent term of poly and sigmoid kernels
+    row_norms (np.array): squared norms of row subjects, required by the rbf kernel
+    col_norms (np.array): squared norms of column subjects, required by the rbf kernel
+
+    Returns
+    ----------
+    kernel_matrix (np.array): kernel values, rows x columns
+    """
+    if kernel == 'linear':
+        return gram
+    elif kernel == 'poly':
+        return (gamma * gram + coef0) ** degree
+    elif kernel == 'rbf':
+        return np.exp(-gamma * np.maximum(row_norms[:, None] + col_norms[None, :] - 2 * gram, 0))
+    elif kernel == 'sigmoid':
+        return np.tanh(gamma * gram + coef0)
+
+    raise ValueError(f'Unknown kernel {kernel}')
+
+def _get_gamma(gamma, variance, n_features):
+    # 'scale' gives 1 / (n_features * X.var()), as in SVC
+    return 1. / (n_features * variance) if gamma == 'scale' else gamma
+
+class PrecomputedSVC(ClassifierMixin, BaseEstimator):
+    """
+    Support vector classifier fitted with libsvm on a Gram matrix computed
+    once per fit, the kernel being derived from dot products between subjects,
+    with coef_ and classes_ following the layout of sklearn's SVC(kernel='linear')
+
+    Parameters
+    ----------
+    C (float): inverse regularization strength
+    kernel (str): linear, poly, rbf or sigmoid, as in SVC
+    gamma (float): kernel coefficient of poly, rbf and sigmoid kernels, or 'scale' as in SVC
+    degree (int): degree of the poly kernel
+    coef0 (float): independent term of poly and sigmoid kernels
+    """
+    def __init__(self, C = 1.0, kernel = 'linear', gamma = 'scale', degree = 3, coef0 = 0.):
+        self.C = C
+        self.kernel = kernel
+        self.gamma = gamma
+        self.degree = degree
+        self.coef0 = coef0
+
+    def _kernel(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        gram = X @ self.support_vectors_.T
+        norms = (np.einsum('ij,ij->i', X, X), self._support_norms) if self.kernel == 'rbf' else (None, None)
+        return apply_kernel(gram, self.kernel, self._gamma, self.degree, self.coef0, *norms)
+
+    def fit(self, X, y, gram = None):
+        """
+        Fit a precomputed kernel SVC
+
+        Parameters
+        ----------
+        X (np.array): features, subjects x features
+        y (np.array): class labels
+        gram (np.array): dot products between subjects of X, computed if None
+
+        Returns
+        ----------
+        self (PrecomputedSVC): fitted estimator
+        """
+        X = np.asarray(X, dtype=np.float64)
+        gram = X @ X.T if gram is None else gram
+        self._gamma = _get_gamma(self.gamma, X.var(), X.shape[1])
+        norms = np.diag(gram)
+
+        self.svc_ = SVC(kernel = 'precomputed', C = self.C).fit(apply_kernel(gram, self.kernel, self._gamma, self.degree, self.coef0, norms, norms), y)
+
+        # only support vectors are kept, kernels of new subjects being computed against them
+
+        self.classes_ = self.svc_.classes_
+        self.support_ = self.svc_.support_
+        self.support_vectors_ = X[self.support_]
+        self._support_norms = norms[self.support_]
+        self.n_support_ = self.svc_.n_support_
+        self.dual_coef_ = self.svc_.dual_coef_
+        self.intercept_ = self.svc_.intercept_
+        self.n_features_in_ = X.shape[1]
+
+        return self
+
+    @property
+    def coef_(self):
+        """
+        Weights in feature space of each pair of classes, only defined for a linear kernel
+        """
+        check_is_fitted(self)
+        if self.kernel != 'linear':
+            raise AttributeError('coef_ is only available when using a linear kernel')
+
+        # as in libsvm, the weights of pair (i, j) sum the dual coefficients of
+        # the support vectors of both classes against the other class
+
+        bounds = np.concatenate([[0], np.cumsum(self.n_support_)])
+        coef = []
+        for i, j in combinations(range(len(self.classes_)), 2):
+            sv_i, sv_j = slice(bounds[i], bounds[i + 1]), slice(bounds[j], bounds[j + 1])
+            coef.append(self.dual_coef_[j - 1, sv_i] @ self.support_vectors_[sv_i] + self.dual_coef_[i, sv_j] @ self.support_vectors_[sv_j])
+
+        return np.vstack(coef)
+
+    def decision_function(self, X):
+        """
+        Get decision values, as returned by SVC
+
+        Parameters
+        ----------
+        X (np.array): features, subjects x features
+
+        Returns
+        ----------
+        decision (np.array): subjects (x classes) decision values
+        """
+        check_is_fitted(self)
+        return self.svc_.decision_function(self._pad(self._kernel(X)))
+
+    def predict(self, X):
+        """
+        Predict class labels
+
+        Parameters
+        ----------
+        X (np.array): features, subjects x features
+
+        Returns
+        ----------
+        y (np.array): predicted class labels
+        """
+        check_is_fitted(self)
+        return self.svc_.predict(self._pad(self._kernel(X)))
+
+    def _pad(self, kernel_matrix):
+        # libsvm expects kernels against all training subjects, only the columns of support vectors being read
+        padded = np.zeros((len(kernel_matrix), self.svc_.shape_fit_[0]))
+        padded[:, self.support_] = kernel_matrix
+        return padded
+
+def back_project(coef, reducer = None):
+    """
+    Map weights of a linear classifier fitted on reduced features back to the features before reduction
+
+    Parameters
+    ----------
+    coef (np.array): weights of each pair of classes, pairs x components
+    reducer (TransformerMixin): fitted reduction step, PCA or SVD components or a feature selector, None without reduction
+
+    Returns
+    ----------
+    weights (np.array): weights of each pair of classes, pairs x features
+    """
+    if reducer is None:
+        return coef
+    elif hasattr(reducer, 'components_'):
+        return coef @ reducer.components_
+
+    return reducer.inverse_transform(coef)
+
+def _score_fold_path(estimator, X, y, train, test, Cs, transformer = None):
+    scaler = clone(transformer).fit(X[train], y[train]) if transformer is not None else StandardScaler().fit(X[train])
+    X_train, X_test = scaler.transform(X[train]), scaler.transform(X[test])
+    estimator = clone(estimator).set_params(warm_start = True)
+
+    scores = []
+    for C in Cs:
+        estimator.set_params(C = C).fit(X_train, y[train])
+        scores.append((estimator.score(X_train, y[train]), estimator.score(X_test, y[test])))
+
+    return scores
+
+def fit_c_path(estimator, X, y, Cs, cv, n_jobs = 1, transformer = None):
+    """
+    Cross-validate a primal SVM along a path of C values, scaling each fold
+    once, sgd fits being warm started from the solution of the previous C
+    while liblinear, which has no warm start, refits each C from scratch
+
+    Parameters
+    ----------
+    estimator (PrimalSVC): estimator to cross-validate
+    X (np.array): features, subjects x features
+    y (np.array): class labels
+    Cs (list): values of C to score
+    cv (list): train and validation indices of each fold
+    n_jobs (int): number of folds fitted concurrently, solvers releasing the GIL, -1 to use all cores
+    transformer (TransformerMixin): transformer fitted once per fold instead of the scaler, e.g. scaling and reduction
+
+    Returns
+    ----------
+    history (pd.DataFrame): search history with the columns of GridSearchCV.cv_results_
+    """
+    Cs = sorted(Cs)
+    X = np.asarray(X)
+    y = np.asarray(y)
+    n_jobs = os.cpu_count() if n_jobs == -1 else max(n_jobs, 1)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        folds = list(executor.map(lambda split: _score_fold_path(estimator, X, y, *split, Cs, transformer), cv))
+
+    scores = np.asarray(folds)
+    history = pd.DataFrame({
+                'param_svc__kernel' : estimator.kernel,
+                'param_svc__C' : Cs,
+                'params' : [{'svc__kernel' : estimator.kernel, 'svc__C' : C} for C in Cs],
+                **{f'split{k}_test_score' : scores[k, :, 1] for k in range(len(folds))},
+                'mean_test_score' : scores[:, :, 1].mean(axis=0),
+                'std_test_score' : scores[:, :, 1].std(axis=0),
+                **{f'split{k}_train_score' : scores[k, :, 0] for k in range(len(folds))},
+                'mean_train_score' : scores[:, :, 0].mean(axis=0),
+                'std_train_score' : scores[:, :, 0].std(axis=0),
+                })
+    history['rank_test_score'] = history['mean_test_score'].rank(ascending=False, method='min').astype(int)
+
+    return history
+
+def get_gram(X, train, cache_dir = None, digest = None, transformer = None, y = None):
+    """
+    Compute the dot products between all subjects, features being standardized
+    with the mean and variance of the training subjects, cached on disk by
+    features, training subjects and transformer
+
+    Parameters
+    ----------
+    X (np.array): features, subjects x features
+    train (np.array): indices of training subjects, fitting the scaler
+    cache_dir (str): directory caching Gram matrices, None to skip caching
+    digest (str): digest of X, computed if None
+    transformer (TransformerMixin): transformer fitted instead of the scaler, e.g. scaling and reduction
+    y (np.array): class labels, fitting supervised transformers
+
+    Returns
+    ----------
+    gram (np.array): subjects x subjects dot products
+    """
+    if cache_dir:
+        digest = digest or hashlib.sha256(np.ascontiguousarray(X)).hexdigest()
+        path = os.path.join(cache_dir, f'gram_{get_key(digest, X.shape, str(X.dtype), np.asarray(train).tolist(), repr(transformer), None if y is None else np.asarray(y)[train].tolist())}.npy')
+        if os.path.exists(path):
+            return np.load(path)
+
+    transformer = clone(transformer) if transformer is not None else StandardScaler()
+    X_scaled = transformer.fit(X[train], None if y is None else y[train]).transform(X).astype(np.float64, copy=False)
+    gram = X_scaled @ X_scaled.T
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(f'{path}.tmp.npy', gram)
+        os.replace(f'{path}.tmp.npy', path)
+
+    return gram
+
+def _score_fold_gram(X, y, train, test, candidates, cache_dir, digest, transformer):
+    gram = get_gram(X, train, cache_dir, digest, transformer, y)
+    norms = np.diag(gram)
+    train_train, test_train = np.ix_(train, train), np.ix_(test, train)
+
+    # transformed training features being centered, 1 / (n_features * X.var()) of
+    # the 'scale' gamma is the number of training subjects over the trace of their Gram
+    scale = len(train) / np.trace(gram[train_train])
+
+    # candidates sharing a kernel reuse its matrix, only the solver running for each value of C
+
+    kernels = {}
+    scores = []
+    for params in candidates:
+        kernel = params.get('kernel', 'linear')
+        gamma = scale if params.get('gamma', 'scale') == 'scale' else params['gamma']
+        spec = (kernel, gamma, params.get('degree', 3), params.get('coef0', 0.))
+        if spec not in kernels:
+            kernels[spec] = apply_kernel(gram, *spec, norms, norms)
+
+        svc = SVC(kernel = 'precomputed', C = params.get('C', 1.)).fit(kernels[spec][train_train], y[train])
+        scores.append((svc.score(kernels[spec][train_train], y[train]), svc.score(kernels[spec][test_train], y[test])))
+
+    return scores
+
+def fit_gram_search(X, y, param_grid, cv, search = 'grid', n_iter = 50, cache_dir = None, n_jobs = 1, transformer = None, random_state = None):
+    """
+    Cross-validate SVC candidates on Gram matrices computed once per fold,
+    kernels being derived from the Gram matrix so that each candidate only
+    costs its solver time
+
+    Parameters
+    ----------
+    X (np.array): features, subjects x features
+    y (np.array): class labels
+    param_grid (list): parameter grids or distributions of the svc step, as returned by get_param_grid
+    cv (list): train and validation indices of each fold
+    search (str): grid for all candidates of the grid, random to sample n_iter candidates
+    n_iter (int): number of candidates sampled by random searches
+    cache_dir (str): directory caching Gram matrices across searches, None to skip caching
+    n_jobs (int): number of folds fitted concurrently, libsvm releasing the GIL, -1 to use all cores
+    transformer (TransformerMixin): transformer fitted once per fold instead of the scaler, e.g. scaling and reduction
+    random_state (int): seed of the candidates sampled by random searches
+
+    Returns
+    ----------
+    history (pd.DataFrame): search history with the columns of GridSearchCV.cv_results_
+    """
+    X = np.asarray(X)
+    y = np.asarray(y)
+    params = list(ParameterGrid(param_grid) if search == 'grid' else ParameterSampler(param_grid, n_iter, random_state = random_state))
+    candidates = [{k.split('__')[-1] : v for k, v in p.items()} for p in params]
+    digest = hashlib.sha256(np.ascontiguousarray(X)).hexdigest() if cache_dir else None
+    n_jobs = os.cpu_count() if n_jobs == -1 else max(n_jobs, 1)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        folds = list(executor.map(lambda split: _score_fold_gram(X, y, *split, candidates, cache_dir, digest, transformer), cv))
+
+    scores = np.asarray(folds)
+    history = pd.DataFrame({
+                **{f'param_{name}' : [p.get(name, np.nan) for p in params] for name in sorted(set().union(*params))},
+                'params' : params,
+                **{f'split{k}_test_score' : scores[k, :, 1] for k in range(len(folds))},
+                'mean_test_score' : scores[:, :, 1].mean(axis=0),
+                'std_test_score' : scores[:, :, 1].std(axis=0),
+                **{f'split{k}_train_score' : scores[k, :, 0] for k in range(len(folds))},
+                'mean_train_score' : scores[:, :, 0].mean(axis=0),
+                'std_train_score' : scores[:, :, 0].std(axis=0),
+                })
+    history['rank_test_score'] = history['mean_test_score'].rank(ascending=False, method='min').astype(int)
+
+    return history
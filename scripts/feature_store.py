@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"functions for storing subject connectomes in a single memory-mapped feature matrix"
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from sklearn.utils import Bunch
+
+__all__ = [
+'DTYPES',
+'encode_features',
+'decode_features',
+'get_store_paths',
+'save_feature_store',
+'load_feature_store',
+'read_features'
+]
+
+# storage dtypes of connectomes, int16 holding Fisher z-transformed correlations
+# quantized in steps of 1/Z_SCALE, i.e. |z| < 8 and |r| < 0.9999997
+DTYPES = ['float64', 'float32', 'float16', 'int16']
+Z_SCALE = 2**12
+
+def encode_features(features, dtype = 'float32'):
+    """
+    Convert connectivity values to their storage dtype
+
+    Parameters
+    ----------
+    features (np.array): connectivity values, correlations for the int16 dtype
+    dtype (str): storage dtype, one of DTYPES
+
+    Returns
+    ----------
+    encoded (np.array): values in the storage dtype
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f'Unknown storage dtype {dtype}, expected one of {DTYPES}')
+
+    features = decode_features(features)
+    if dtype != 'int16':
+        return features.astype(dtype, copy=False)
+
+    limit = np.iinfo(np.int16).max / Z_SCALE
+    z = np.arctanh(np.clip(features, -np.tanh(limit), np.tanh(limit)))
+    return np.rint(np.clip(z * Z_SCALE, -np.iinfo(np.int16).max, np.iinfo(np.int16).max)).astype(np.int16)
+
+def decode_features(features):
+    """
+    Convert stored connectivity values back to floating point, the encoding being given by their dtype
+
+    Parameters
+    ----------
+    features (np.array): values in a storage dtype
+
+    Returns
+    ----------
+    decoded (np.array): float32 values, float64 if stored as float64
+    """
+    features = np.asarray(features)
+    if features.dtype == np.int16:
+        return np.tanh(features.astype(np.float32) / np.float32(Z_SCALE))
+
+    return features.astype(np.result_type(features.dtype, np.float32), copy=False)
+
+def get_store_paths(path, task = 'rest', atlas = None):
+    """
+    Get the paths of the feature matrix and its metadata sidecar
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory or equivalent
+    task (str): functional task of the connectivity data
+    atlas (str): name of atlas namespace, None for the top level connectomes directory
+
+    Returns
+    ----------
+    data_path (str): path to .npy feature matrix
+    meta_path (str): path to JSON metadata sidecar
+    """
+    stem = os.path.join(os.path.abspath(path), 'connectomes', *([atlas] if atlas else []), f'{task}_features')
+    return f'{stem}.npy', f'{stem}.json'
+
+def save_feature_store(path, task, subjects, connectomes, metadata = {}, atlas = None, dtype = 'float32'):
+    """
+    Write subject connectomes to a contiguous feature matrix, one row per
+    subject, alongside a sidecar holding the subject index and metadata
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory or equivalent
+    task (str): functional task of the connectivity data
+    subjects (list): subject identifiers (sub-XXX) in row order
+    connectomes (list): paths to the .npy connectome of each subject
+    metadata (dict): additional JSON serializable metadata to store
+    atlas (str): name of atlas namespace, None for the top level connectomes directory
+    dtype (str): storage dtype of the matrix, one of DTYPES
+
+    Returns
+    ----------
+    meta (dict): metadata written to the sidecar
+    """
+    data_path, meta_path = get_store_paths(path, task, atlas)
+    n_edges = np.load(connectomes[0], mmap_mode='r').shape[0]
+
+    # rows are streamed into the memmap, so the full matrix is never held in memory,
+    # each writer using its own temporary files so that concurrent runs do not interleave
+
+    sha = hashlib.sha256()
+    fd, data_tmp = tempfile.mkstemp(dir=os.path.dirname(data_path), prefix=f'{os.path.basename(data_path)}.', suffix='.tmp.npy')
+    os.close(fd)
+    features = np.lib.format.open_memmap(data_tmp, mode='w+', dtype=dtype, shape=(len(subjects), n_edges))
+    for row, connectome in enumerate(connectomes):
+        features[row] = encode_features(np.load(connectome), dtype)
+        sha.update(features[row].tobytes())
+    features.flush()
+    del features
+
+    meta = {
+        **metadata,
+        'task' : task,
+        'subjects' : list(subjects),
+        'n_edges' : int(n_edges),
+        'dtype' : dtype,
+        'digest' : sha.hexdigest()
+    }
+
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(meta_path), prefix=f'{os.path.basename(meta_path)}.', suffix='.tmp', delete=False) as savefile:
+        json.dump(meta, savefile)
+    os.replace(data_tmp, data_path)
+    os.replace(savefile.name, meta_path)
+
+    return meta
+
+def load_feature_store(path, task = 'rest', atlas = None):
+    """
+    Memory-map the feature matrix of a task without reading it into memory
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory or equivalent
+    task (str): functional task of the connectivity data
+    atlas (str): name of atlas namespace, None for the top level connectomes directory
+
+    Returns
+    ----------
+    store (Bunch): read-only feature matrix in its storage dtype, subject
+    to row index and metadata, None if no feature store exists
+    """
+    data_path, meta_path = get_store_paths(path, task, atlas)
+    if not(os.path.exists(data_path) and os.path.exists(meta_path)):
+        return None
+
+    with open(meta_path, 'r') as o:
+        meta = json.load(o)
+
+    store = Bunch(
+        features = np.load(data_path, mmap_mode='r'),
+        index = {sub : row for row, sub in enumerate(meta['subjects'])},
+        metadata = meta,
+        )
+
+    return store
+
+def read_features(store, subjects = None):
+    """
+    Read rows of a feature store into memory as floating point values
+
+    Parameters
+    ----------
+    store (Bunch): feature store, as returned by load_feature_store
+    subjects (list): subjects to read in order, None for all subjects
+
+    Returns
+    ----------
+    features (np.array): subjects x edges connectivity values, as returned by decode_features
+    """
+    if subjects is None:
+        return decode_features(store.features[:])
+
+    return decode_features(store.features[[store.index[sub] for sub in subjects]])
@@ -5,18 +5,30 @@
 import argparse
 
 import os
-import glob
 import json
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import loguniform, t
 from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import confusion_matrix, classification_report, accuracy_score
-from sklearn.model_selection import train_test_split, StratifiedKFold, GridSearchCV
+from sklearn.decomposition import IncrementalPCA, TruncatedSVD
+from sklearn.feature_selection import SelectKBest, f_classif
+from sklearn.metrics import confusion_matrix, classification_report, accuracy_score, balanced_accuracy_score, f1_score
+# imported for its side effect of enabling the halving searches
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import train_test_split, StratifiedKFold, RepeatedStratifiedKFold, GridSearchCV, RandomizedSearchCV, HalvingGridSearchCV, HalvingRandomSearchCV
 from sklearn.pipeline import Pipeline
 from sklearn.svm import SVC
 from format_data import load_data
+from feature_store import load_feature_store, read_features, decode_features
+from estimators import PrimalSVC, PrecomputedSVC, back_project, get_gram, fit_c_path, fit_gram_search
+from permutation_test import permutation_test
+from model_store import get_feature_spec, save_model
+from profiling import enable, stage, write_profile
 
-def get_model_input(path, task = 'rest', subjects = [], phenotypes = []):
+def get_model_input(path, task = 'rest', subjects = [], phenotypes = [], atlas = None):
     """
     Prepare input data for model fitting
 
@@ -26,27 +38,307 @@ def get_model_input(path, task = 'rest', subjects = [], phenotypes = []):
     task (str): Functional task to use connectivity data of
     subjects (list): Subjects to get data for
     phenotypes (list): Phenotypic values to classify
+    atlas (str): Atlas namespace of connectivity data, None for the top level connectomes directory
 
     Returns
     ----------
-    features (np.array): Array of subject connectivity matrices
+    features (np.array): Array of subject connectivity matrices, float32 unless stored as float64
     labels (np.array): Array of phenotypic labels
     """
     data = load_data(path, subjects)
-    labels = data.phenotypic.T[1]
-    
-    if not(subjects):
-        subjects = [sub.split('-')[1] for sub in data.order]
-    features = np.asarray([np.load(os.path.join(path, 'connectomes', f'sub-{sub}_{task}_connectome.npy'), allow_pickle=True) for sub in subjects])
-    
+    labels = np.asarray(data.diagnosis, dtype=str)
+    subjects = data.order
+
     if phenotypes:
-        keep = [bool(lab in phenotypes) for lab in labels]
-        features = features[keep]
+        keep = np.isin(labels, phenotypes)
+        subjects = [sub for sub, k in zip(subjects, keep) if k]
         labels = labels[keep]
 
+    # select rows from the memory-mapped feature store, falling back on per-subject files,
+    # only the selected rows being decoded from their storage dtype
+
+    store = load_feature_store(path, task, atlas)
+    if store and all(sub in store.index for sub in subjects):
+        features = read_features(store, subjects)
+    else:
+        features = decode_features(np.asarray([np.load(os.path.join(path, 'connectomes', *([atlas] if atlas else []), f'{sub}_{task}_connectome.npy')) for sub in subjects]))
+
     return features, labels
 
+def get_param_grid(kernels = ['linear'], search = 'grid'):
+    """
+    Get the SVC hyperparameters to search over for each kernel
+
+    Parameters
+    ----------
+    kernels (list): SVC kernels to search over
+    search (str): search strategy, grid, halving and path searches get a grid of values,
+    random searches get log-uniform distributions
+
+    Returns
+    ----------
+    param_grid (list): one parameter grid or distribution per kernel
+    """
+    if search in ['random', 'halving_random']:
+        C = loguniform(1e-5, 1e7)
+        gamma = loguniform(1e-7, 1e-1)
+    else:
+        C = [i for i in 10. ** np.arange(-5,8, step = 0.5)]
+        gamma = [i for i in 10. ** np.arange(-7,0)]
+
+    param_grid = []
+    for kernel in kernels:
+        grid = {'svc__kernel' : [kernel], 'svc__C' : C}
+        if kernel != 'linear':
+            grid['svc__gamma'] = gamma
+        param_grid.append(grid)
+
+    return param_grid
+
+def get_classifier(solver = 'libsvm'):
+    """
+    Initialize a support vector classifier with the given solver backend
+
+    Parameters
+    ----------
+    solver (str): libsvm for the kernelized SVC, precomputed for libsvm on
+    Gram matrices between subjects, liblinear or sgd for a linear SVM solved
+    in the primal with the same coefficient layout
+
+    Returns
+    ----------
+    classifier (SVC, PrecomputedSVC or PrimalSVC): unfitted classifier
+    """
+    if solver == 'libsvm':
+        return SVC()
+    elif solver == 'precomputed':
+        return PrecomputedSVC()
+
+    return PrimalSVC(solver = solver)
+
+def get_reducer(reduction = None, n_components = 100, batch_size = 200):
+    """
+    Initialize a dimensionality reduction step, run between scaling and classification
+
+    Parameters
+    ----------
+    reduction (str): pca for incremental PCA fitted in batches of subjects, svd for
+    randomized truncated SVD, kbest for the edges with the highest ANOVA F-values, None to skip
+    n_components (int): number of components, or of edges kept by kbest
+    batch_size (int): number of subjects per batch of incremental PCA
+
+    Returns
+    ----------
+    reducer (TransformerMixin): unfitted reduction step, None without reduction
+    """
+    if not(reduction):
+        return None
+    elif reduction == 'pca':
+        return IncrementalPCA(n_components = n_components, batch_size = max(batch_size, n_components))
+    elif reduction == 'svd':
+        # a fixed seed keeps the components of a fold identical across candidates and cached Gram matrices
+        return TruncatedSVD(n_components = n_components, algorithm = 'randomized', random_state = 0)
+    elif reduction == 'kbest':
+        return SelectKBest(f_classif, k = n_components)
+
+    raise ValueError(f'Unknown reduction {reduction}')
+
+def get_search(estimator, param_grid, search = 'grid', cv = None, n_iter = 50, n_jobs = 1, verbose = 0, random_state = None):
+    """
+    Initialize a cross-validated hyperparameter search
+
+    Parameters
+    ----------
+    estimator (Pipeline): estimator to search hyperparameters of
+    param_grid (list): parameter grids, as returned by get_param_grid
+    search (str): search strategy, one of grid, random, halving or halving_random
+    cv (list): train and validation indices of each fold
+    n_iter (int): number of candidates sampled by random searches
+    n_jobs (int): number of fits run in parallel, -1 to use all cores
+    verbose (int): verbosity of the search
+    random_state (int): seed of the candidates sampled by random searches and of halving subsamples
+
+    Returns
+    ----------
+    search (BaseSearchCV): unfitted search
+    """
+    kwargs = dict(estimator = estimator, cv = cv, return_train_score = True, n_jobs = n_jobs, verbose = verbose)
+
+    if search == 'grid':
+        return GridSearchCV(param_grid = param_grid, **kwargs)
+    elif search == 'random':
+        return RandomizedSearchCV(param_distributions = param_grid, n_iter = n_iter, random_state = random_state, **kwargs)
+    elif search == 'halving':
+        return HalvingGridSearchCV(param_grid = param_grid, random_state = random_state, **kwargs)
+    elif search == 'halving_random':
+        return HalvingRandomSearchCV(param_distributions = param_grid, random_state = random_state, **kwargs)
+
+    raise ValueError(f'Unknown search strategy {search}')
+
+
+
+def fit_model(X, y, splits, solver = 'libsvm', kernels = ['linear'], search = 'grid', n_iter = 50, n_jobs = 1, cache_dir = None, verbose = 0, reduction = None, n_components = 100, reduction_batch = 200, random_state = None):
+    """
+    Search SVC hyperparameters over cross-validation folds and refit the best
+    model on all data, scalers and reduction steps fitted on each fold being cached
+    across candidates, as are Gram matrices of grid and random searches with the precomputed solver
+
+    Parameters
+    ----------
+    X (np.array): features, subjects x features
+    y (np.array): class labels
+    splits (list): train and validation indices of each fold
+    solver (str): SVM solver, as in get_classifier
+    kernels (list): SVC kernels to search over
+    search (str): search strategy, one of grid, random, halving, halving_random or path
+    n_iter (int): number of candidates sampled by random searches
+    n_jobs (int): number of fits run in parallel, -1 to use all cores
+    cache_dir (str): directory caching fitted scalers and Gram matrices, a temporary directory if None
+    verbose (int): verbosity of the search
+    reduction (str): dimensionality reduction step, as in get_reducer, None to classify all features
+    n_components (int): number of components or edges kept by the reduction step
+    reduction_batch (int): number of subjects per batch of incremental PCA
+    random_state (int): seed of the candidates sampled by random searches
+
+    Returns
+    ----------
+    best_estimator (Pipeline): scaler, reduction step and classifier refitted with the best hyperparameters
+    history (pd.DataFrame): cross-validation results of all candidates
+    """
+    cache = cache_dir or tempfile.mkdtemp()
+    reducer = get_reducer(reduction, n_components, reduction_batch)
+    pipe = Pipeline(steps = [('scaler', StandardScaler()), *([('reduce', reducer)] if reducer else []), ('svc', get_classifier(solver))], memory = cache)
+    param_grid = get_param_grid(kernels, search)
+
+    # searches fitting folds themselves get all steps but the classifier as one transformer
+
+    transformer = Pipeline(steps = pipe.steps[:-1])
+
+    if search == 'path':
+        history = fit_c_path(pipe.named_steps['svc'], X, y, param_grid[0]['svc__C'], splits, n_jobs, transformer)
+        best_estimator = pipe.set_params(**history.loc[history['rank_test_score'].idxmin(), 'params']).fit(X, y)
+    elif solver == 'precomputed' and search in ['grid', 'random']:
+        history = fit_gram_search(X, y, param_grid, splits, search, n_iter, os.path.join(cache, 'gram'), n_jobs, transformer, random_state)
+        gram = get_gram(np.asarray(X), np.arange(len(X)), os.path.join(cache, 'gram'), transformer = transformer, y = np.asarray(y))
+        best_estimator = pipe.set_params(**history.loc[history['rank_test_score'].idxmin(), 'params']).fit(X, y, svc__gram = gram)
+    else:
+        search = get_search(pipe, param_grid, search, splits, n_iter, n_jobs, verbose, random_state)
+        search.fit(X, y)
+        best_estimator = search.best_estimator_
+        history = pd.DataFrame(search.cv_results_)
+
+    if not(cache_dir):
+        shutil.rmtree(cache, ignore_errors=True)
+
+    return best_estimator.set_params(memory = None), history
 
+# per-process state of outer fold workers, set up once by init_outer_worker
+_outer = {}
+
+def init_outer_worker(X, y, params):
+    """
+    Initialize the data and search parameters used by the current process
+
+    Parameters
+    ----------
+    X (np.array): features, subjects x features
+    y (np.array): class labels
+    params (dict): inner cross-validation and fit_model parameters
+    """
+    _outer.update(X = X, y = y, params = params)
+
+def fit_outer_fold(fold, train, test):
+    """
+    Search hyperparameters on the training subjects of an outer fold and
+    evaluate the best model on its held out subjects
+
+    Parameters
+    ----------
+    fold (int): index of outer fold
+    train (np.array): indices of training subjects
+    test (np.array): indices of held out subjects
+
+    Returns
+    ----------
+    result (dict): fold metrics, selected hyperparameters and confusion matrix
+    """
+    X, y, params = _outer['X'], _outer['y'], _outer['params']
+
+    inner = StratifiedKFold(n_splits = params['inner_splits'], shuffle = True, random_state = params['seed'])
+    best_estimator, _ = fit_model(X[train], y[train], list(inner.split(X[train], y[train])), **params['model'])
+    y_pred = best_estimator.predict(X[test])
+    svc = best_estimator.named_steps['svc']
+
+    return {
+        'fold' : fold,
+        'accuracy' : accuracy_score(y[test], y_pred),
+        'balanced_accuracy' : balanced_accuracy_score(y[test], y_pred),
+        'f1_macro' : f1_score(y[test], y_pred, average = 'macro'),
+        'kernel' : svc.kernel,
+        'C' : svc.C,
+        'gamma' : getattr(svc, 'gamma', None) if svc.kernel != 'linear' else None,
+        'confusion_matrix' : confusion_matrix(y[test], y_pred, labels = np.unique(y)),
+    }
+
+def nested_cross_validate(X, y, n_splits = 5, n_repeats = 1, inner_splits = 5, outer_jobs = 1, seed = None, **model_params):
+    """
+    Estimate generalization performance with repeated stratified outer folds,
+    each running its own inner hyperparameter search, outer folds being
+    dispatched to a process pool
+
+    Parameters
+    ----------
+    X (np.array): features, subjects x features
+    y (np.array): class labels
+    n_splits (int): number of outer folds per repeat
+    n_repeats (int): number of repeats of the outer folds
+    inner_splits (int): number of inner folds of the hyperparameter search
+    outer_jobs (int): number of outer folds fitted concurrently, -1 to use all cores
+    seed (int): seed of outer and inner splits and of candidates sampled by random searches
+    model_params: parameters passed on to fit_model
+
+    Returns
+    ----------
+    scores (pd.DataFrame): metrics and selected hyperparameters of each outer fold
+    summary (dict): mean, standard deviation and corrected 95% confidence interval of each metric
+    confusion (pd.DataFrame): confusion matrix of each outer fold
+    """
+    X = np.asarray(X)
+    y = np.asarray(y)
+    folds = list(RepeatedStratifiedKFold(n_splits = n_splits, n_repeats = n_repeats, random_state = seed).split(X, y))
+    params = {'inner_splits' : inner_splits, 'seed' : seed, 'model' : {'random_state' : seed, **model_params}}
+    outer_jobs = os.cpu_count() if outer_jobs == -1 else max(outer_jobs, 1)
+
+    if outer_jobs == 1:
+        init_outer_worker(X, y, params)
+        results = list(map(fit_outer_fold, range(len(folds)), *zip(*folds)))
+    else:
+        with ProcessPoolExecutor(max_workers = outer_jobs, initializer = init_outer_worker, initargs = (X, y, params)) as executor:
+            results = list(executor.map(fit_outer_fold, range(len(folds)), *zip(*folds)))
+
+    label_set = np.unique(y)
+    scores = pd.DataFrame([{k : v for k, v in result.items() if k != 'confusion_matrix'} for result in results])
+    scores.insert(0, 'repeat', scores['fold'] // n_splits)
+    scores['fold'] = scores['fold'] % n_splits
+
+    # confidence intervals of the mean across outer folds, using the t distribution and clipped to the range of the metrics,
+    # folds sharing training subjects so that their variance is corrected as in Nadeau and Bengio (2003)
+
+    summary = {}
+    test_ratio = np.mean([len(test) / len(train) for train, test in folds])
+    for metric in ['accuracy', 'balanced_accuracy', 'f1_macro']:
+        values = scores[metric].to_numpy()
+        half_width = t.ppf(0.975, len(values) - 1) * np.sqrt((1. / len(values) + test_ratio) * values.var(ddof = 1)) if len(values) > 1 else np.nan
+        summary[metric] = {'mean' : values.mean(), 'std' : values.std(ddof = 1) if len(values) > 1 else 0., 'ci95_low' : max(values.mean() - half_width, 0.), 'ci95_high' : min(values.mean() + half_width, 1.)}
+    summary['n_folds'] = len(folds)
+    summary['ci95_method'] = 'nadeau_bengio_corrected_t'
+
+    confusion = pd.concat([
+                pd.DataFrame(result['confusion_matrix'], index = pd.MultiIndex.from_product([[result['fold'] // n_splits], [result['fold'] % n_splits], label_set], names = ['repeat', 'fold', 'label']), columns = label_set)
+                for result in results
+    ])
+
+    return scores, summary, confusion
 
 if __name__ == '__main__':
 
@@ -57,13 +349,40 @@ if __name__ == '__main__':
     parser.add_argument('--file_suffix', type=str, help='Suffix of saved output files', default="")
     parser.add_argument('--subjects', help='Path to file or Python list of subjects to get data for', default=[])
     parser.add_argument('--task', type=str, help='Functional task to use connectivity data of', default='rest')
+    parser.add_argument('--atlas', type=str, help='Atlas namespace of connectivity data, when several atlases were extracted', default=None)
     parser.add_argument('--phenotypes', help='Path to file or Python list phenotypic values to classify', default=[])
+    parser.add_argument('--search', type=str, choices=['grid', 'random', 'halving', 'halving_random', 'path'], help='Hyperparameter search strategy, path scales each fold once along the C grid and requires a primal solver, only sgd warm starting each C from the previous one', default='grid')
+    parser.add_argument('--solver', type=str, choices=['libsvm', 'precomputed', 'liblinear', 'sgd'], help='SVM solver, precomputed fits libsvm on Gram matrices cached per fold, liblinear and sgd solve linear SVMs in the primal', default='libsvm')
+    parser.add_argument('--kernels', type=str, nargs='+', help='SVC kernels to search over', default=['linear'])
+    parser.add_argument('--reduction', type=str, choices=['pca', 'svd', 'kbest'], help='Dimensionality reduction step between scaling and classification, pca streaming subjects in batches, kbest keeping the edges with the highest F-values', default=None)
+    parser.add_argument('--n_components', type=int, help='Number of components, or of edges kept by kbest, of the reduction step', default=100)
+    parser.add_argument('--reduction_batch', type=int, help='Number of subjects per batch of incremental PCA', default=200)
+    parser.add_argument('--n_iter', type=int, help='Number of candidates sampled by random searches', default=50)
+    parser.add_argument('--n_jobs', type=int, help='Number of fits run in parallel, -1 to use all cores', default=1)
+    parser.add_argument('--nested', action='store_true', help='Evaluate with nested cross-validation instead of a single train/test split')
+    parser.add_argument('--outer_splits', type=int, help='Number of outer folds of nested cross-validation', default=5)
+    parser.add_argument('--outer_repeats', type=int, help='Number of repeats of the outer folds of nested cross-validation', default=1)
+    parser.add_argument('--outer_jobs', type=int, help='Number of outer folds fitted in parallel processes, -1 to use all cores', default=1)
+    parser.add_argument('--seed', type=int, help='Seed of data splits and of candidates sampled by random searches', default=None)
+    parser.add_argument('--n_permutations', type=int, help='Number of label permutations testing the significance of the best estimator, 0 to skip', default=0)
+    parser.add_argument('--permutation_batch', type=int, help='Number of permutations scored per parallel task', default=50)
+    parser.add_argument('--permutation_jobs', type=int, help='Number of processes scoring permutations, -1 to use all cores', default=1)
+    parser.add_argument('--profile_dir', type=str, help='Directory to write stage timings, memory and reads of this run to', default=None)
+    parser.add_argument('--cache_dir', type=str, help='Directory caching fitted scalers and Gram matrices across candidates and runs, a temporary directory by default', default=None)
     parser.add_argument('--verbosity', type=int, default=1)
     args = parser.parse_args()
+    enable(bool(args.profile_dir))
+
+    if args.solver in ['liblinear', 'sgd'] and args.kernels != ['linear']:
+        parser.error('Primal solvers only support a linear kernel')
+    if args.search == 'path' and args.solver not in ['liblinear', 'sgd']:
+        parser.error('Path search requires a primal solver')
+    if args.nested and args.n_permutations:
+        parser.error('Permutation tests are run on the best estimator of a single split, not with --nested')
+    n_jobs = os.cpu_count() if args.n_jobs == -1 else max(args.n_jobs, 1)
 
     save_to = os.path.join('/'.join(os.path.abspath(args.path).split('/')[:-2]), 'results', 'ml_metrics')
-    if not(glob.glob(save_to)):
-        os.mkdir(save_to)
+    os.makedirs(save_to, exist_ok=True)
 
     if args.subjects:
         if type(args.subjects) is str:
@@ -86,94 +405,173 @@ if __name__ == '__main__':
     if args.verbosity:
         print('Preparing subject data...')
 
-    features, labels = get_model_input(args.path, args.task, subjects, phenotypes)
+    with stage('load_features'):
+        features, labels = get_model_input(args.path, args.task, subjects, phenotypes, args.atlas)
     label_set = np.unique(labels)
     lab_names = {'CONTROL' : 'Control', 'BIPOLAR' : 'Bipolar', 'ADHD' : 'ADHD', 'SCHZ' : 'Schizophrenia'}
 
-    # split data
+    if args.nested:
+
+        # nested cross-validation replaces the single train/test split
+
+        if args.verbosity:
+            print(f'Performing nested cross-validation over {args.outer_repeats} x {args.outer_splits} outer folds...')
+
+        with stage('nested_cv', n_folds=args.outer_splits * args.outer_repeats):
+            scores, summary, confusion = nested_cross_validate(
+                                                            features,
+                                                            labels,
+                                                            n_splits = args.outer_splits,
+                                                            n_repeats = args.outer_repeats,
+                                                            outer_jobs = args.outer_jobs,
+                                                            seed = args.seed,
+                                                            solver = args.solver,
+                                                            kernels = args.kernels,
+                                                            search = args.search,
+                                                            n_iter = args.n_iter,
+                                                            n_jobs = n_jobs,
+                                                            reduction = args.reduction,
+                                                            n_components = args.n_components,
+                                                            reduction_batch = args.reduction_batch,
+            )
+
+        with open(os.path.join(save_to, f'svc_{args.task}_nested_summary{args.file_suffix}.json'), 'w') as savefile:
+            json.dump(summary, savefile)
+        scores.to_csv(os.path.join(save_to, f'svc_{args.task}_nested_scores{args.file_suffix}.tsv'), sep='\t', index=False)
+        confusion.to_csv(os.path.join(save_to, f'svc_{args.task}_nested_confusion_matrices{args.file_suffix}.tsv'), sep='\t')
+
+        if args.verbosity:
+            acc = summary['accuracy']
+            print(f"Accuracy {acc['mean']:.3f} (95% CI {acc['ci95_low']:.3f}-{acc['ci95_high']:.3f}), nested metrics saved to {save_to}")
 
-    if args.verbosity:
-        print('Getting independent test data...')
-
-    X, X_test, y, y_test = train_test_split(
-                                                        features,
-                                                        labels,
-                                                        test_size = 0.3,
-                                                        shuffle = True,
-                                                        stratify = labels
-    )
+    else:
 
-    if args.verbosity:
-        train_count = [np.count_nonzero((y == lab)) for lab in label_set]
-        test_count = [np.count_nonzero((y_test == lab)) for lab in label_set]
-        print('Train : Test set composition...')
-        print('\n'.join([f'{label_set[i]} = {train_count[i]}:{test_count[i]}' for i in range(len(label_set))]))
+        # split data
 
-    if args.verbosity:
-        print('Generating K fold splits...')
+        if args.verbosity:
+            print('Getting independent test data...')
 
-    idcs = np.asarray(range(len(X)))
-    np.random.shuffle(idcs)
-    X = X[idcs]
-    y = y[idcs]
-    skf = StratifiedKFold(n_splits=5)
-    splits = skf.split(X, y)
+        X, X_test, y, y_test = train_test_split(
+                                                            features,
+                                                            labels,
+                                                            test_size = 0.3,
+                                                            shuffle = True,
+                                                            stratify = labels,
+                                                            random_state = args.seed
+        )
 
+        if args.verbosity:
+            train_count = [np.count_nonzero((y == lab)) for lab in label_set]
+            test_count = [np.count_nonzero((y_test == lab)) for lab in label_set]
+            print('Train : Test set composition...')
+            print('\n'.join([f'{label_set[i]} = {train_count[i]}:{test_count[i]}' for i in range(len(label_set))]))
 
+        if args.verbosity:
+            print('Generating K fold splits...')
 
-    # model 1: sklearn SVC
+        idcs = np.random.default_rng(args.seed).permutation(len(X))
+        X = X[idcs]
+        y = y[idcs]
+        skf = StratifiedKFold(n_splits=5)
+        splits = list(skf.split(X, y))
 
-    if args.verbosity:
-        print('Initializing support vector classifier...')
 
-    pipe = Pipeline(steps = [('scaler', StandardScaler()), ('svc', SVC())])
 
-    param_grid = {
-                'svc__kernel':['linear'],
-                'svc__C': [i for i in 10. ** np.arange(-5,8, step = 0.5)],
-                }
+        # model 1: sklearn SVC
 
-    if args.verbosity:
-        print('Performing grid search...')
+        if args.verbosity:
+            print('Initializing support vector classifier...')
 
-    search = GridSearchCV(estimator = pipe,
-                        param_grid = param_grid,
-                        cv = splits,
-                        return_train_score = True,
-                        verbose = args.verbosity)
+        if args.verbosity:
+            print(f'Performing {args.search} search...')
 
-    search.fit(X,y)
+        with stage('search_fit', search=args.search, solver=args.solver):
+            best_estimator, history = fit_model(X, y, splits, args.solver, args.kernels, args.search, args.n_iter, n_jobs, args.cache_dir, args.verbosity, args.reduction, args.n_components, args.reduction_batch, args.seed)
 
-    if args.verbosity:
-        print('Predicting test data using best estimator')
+        if args.verbosity:
+            print('Predicting test data using best estimator')
 
-    y_pred = search.predict(X_test)
+        with stage('predict'):
+            y_pred = best_estimator.predict(X_test)
 
-    if args.verbosity:
-        print('Getting coefficients...')
+        if args.verbosity:
+            print('Getting coefficients...')
     
-    coefficients = search.best_estimator_.named_steps['svc'].coef_
-    coef_order = search.best_estimator_.named_steps['svc'].classes_
-    coefficients = np.asarray([coefficients, coef_order], dtype=object)
-    np.save(os.path.join('/'.join(save_to.split('/')[:-1]), f'svc_{args.task}_weights{args.file_suffix}'), coefficients, allow_pickle=True)
+        # coefficients only exist in feature space for linear kernels, weights of
+        # reduced features being projected back onto edges, and weights left by an
+        # earlier linear model being removed so they are not read as this model's
+
+        svc = best_estimator.named_steps['svc']
+        weights_path = os.path.join('/'.join(save_to.split('/')[:-1]), f'svc_{args.task}_weights{args.file_suffix}.npy')
+        if svc.kernel == 'linear':
+            coefficients = np.asarray([back_project(svc.coef_, best_estimator.named_steps.get('reduce')), svc.classes_], dtype=object)
+            np.save(weights_path, coefficients, allow_pickle=True)
+        else:
+            if os.path.exists(weights_path):
+                os.remove(weights_path)
+            if args.verbosity:
+                print(f'Best estimator uses a {svc.kernel} kernel, no coefficients saved.')
+
+        # the refitted estimator is saved with the specification of its features, so new subjects can be classified without retraining
+
+        save_model(
+                '/'.join(save_to.split('/')[:-1]),
+                best_estimator,
+                get_feature_spec(args.path, args.task, args.atlas, features.shape[1]),
+                args.task,
+                args.file_suffix,
+                metadata = {'atlas' : args.atlas, 'search' : args.search, 'solver' : args.solver, 'reduction' : args.reduction, 'params' : svc.get_params()}
+        )
     
-    if args.verbosity:
-        print('Getting metrics...')
-
-    cm = confusion_matrix(y_test, y_pred, labels = label_set)
-    cm = np.array(cm)
-    cm = pd.DataFrame(cm, index = label_set, columns = label_set)
-
-    scores = classification_report(y_test, y_pred, labels = label_set, target_names = [lab_names[lab] for lab in label_set], output_dict = True)
-    scores['accuracy'] = accuracy_score(y_test, y_pred)
-
-    history = pd.DataFrame(search.cv_results_)
-
-    with open(os.path.join(save_to, f'svc_{args.task}_classification_report{args.file_suffix}.json'), 'w') as savefile:
-        json.dump(scores, savefile)
-    cm.to_csv(os.path.join(save_to, f'svc_{args.task}_confusion_matrix{args.file_suffix}.tsv'), sep='\t')
-    history.to_csv(os.path.join(save_to, f'svc_{args.task}_search_history{args.file_suffix}.tsv'), sep='\t')
+        if args.verbosity:
+            print('Getting metrics...')
+
+        cm = confusion_matrix(y_test, y_pred, labels = label_set)
+        cm = np.array(cm)
+        cm = pd.DataFrame(cm, index = label_set, columns = label_set)
+
+        scores = classification_report(y_test, y_pred, labels = label_set, target_names = [lab_names[lab] for lab in label_set], output_dict = True)
+        scores['accuracy'] = accuracy_score(y_test, y_pred)
+
+        with open(os.path.join(save_to, f'svc_{args.task}_classification_report{args.file_suffix}.json'), 'w') as savefile:
+            json.dump(scores, savefile)
+        cm.to_csv(os.path.join(save_to, f'svc_{args.task}_confusion_matrix{args.file_suffix}.tsv'), sep='\t')
+        history.to_csv(os.path.join(save_to, f'svc_{args.task}_search_history{args.file_suffix}.tsv'), sep='\t')
+
+        # permutation test of the cross-validated accuracy, hyperparameters fixed to those of the best estimator,
+        # edge selection depending on labels being refitted on each permutation
+
+        if args.n_permutations:
+            if args.verbosity:
+                print(f'Performing permutation test with {args.n_permutations} permutations...')
+
+            with stage('permutation_test', n_permutations=args.n_permutations):
+                supervised = args.reduction == 'kbest'
+                cv_score, null, p_value = permutation_test(
+                                                        X,
+                                                        y,
+                                                        Pipeline(steps = best_estimator.steps[1:]) if supervised else best_estimator.named_steps['svc'],
+                                                        splits,
+                                                        n_permutations = args.n_permutations,
+                                                        batch_size = args.permutation_batch,
+                                                        n_jobs = args.permutation_jobs,
+                                                        seed = args.seed,
+                                                        transformer = Pipeline(steps = best_estimator.steps[:1 if supervised else -1])
+                )
+
+            with open(os.path.join(save_to, f'svc_{args.task}_permutation_test{args.file_suffix}.json'), 'w') as savefile:
+                json.dump({'cv_accuracy' : cv_score, 'p_value' : p_value, 'n_permutations' : args.n_permutations, 'null_mean' : null.mean(), 'null_std' : null.std()}, savefile)
+            pd.DataFrame({'cv_accuracy' : null}).to_csv(os.path.join(save_to, f'svc_{args.task}_permutation_null{args.file_suffix}.tsv'), sep='\t', index_label='permutation')
+
+            if args.verbosity:
+                print(f'Cross-validated accuracy {cv_score:.3f}, p = {p_value:.4f}')
     
     
-    if args.verbosity:
-        print(f'Mertics and model coefficients saved to {"/".join(save_to.split("/")[:-1])}')
+        if args.verbosity:
+            print(f'Mertics and model coefficients saved to {"/".join(save_to.split("/")[:-1])}')
+
+    if args.profile_dir:
+        summary = write_profile(args.profile_dir, 'fit_svm', {'n_subjects' : len(labels), 'n_features' : features.shape[1]})
+        if args.verbosity:
+            print(f'Stage profile saved to {args.profile_dir}')
+            print(summary.round(3).to_string())
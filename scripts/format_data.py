@@ -7,16 +7,22 @@ import pathlib
 
 import os
 import glob
+import tempfile
 import numpy as np
 import json
 import pandas as pd
 from sklearn.utils import Bunch
+from profiling import enable, stage, write_profile
 
 __all__ = [
 'get_directories',
-'get_format_file'
+'get_format_file',
+'load_index',
+'load_data'
 ]
 
+INDEX_FILE = 'metadata_index.npz'
+
 def get_directories(path = '.'):
     """
     Retrieve a list of paths to subject files containing individual data
@@ -30,24 +36,126 @@ def get_directories(path = '.'):
     paths (list): list of paths to all subject folders
     """
     abspath = os.path.abspath(path)
-    paths = [path for path in glob.glob(f'{abspath}/*sub-*')]
+    with os.scandir(abspath) as entries:
+        paths = [entry.path for entry in entries if 'sub-' in entry.name and entry.is_dir()]
     order = [int(path.split('-')[-1]) for path in paths]
     index = np.argsort(order)
     paths = [paths[i] for i in index]
     
     return paths
 
+def get_mtime(path):
+    """
+    Get the modification time of a file or directory
+
+    Parameters
+    ----------
+    path (str): path to file or directory
+
+    Returns
+    ----------
+    mtime (int): modification time in nanoseconds, -1 if the path does not exist
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return -1
+
+def build_index(subject_order, phenotypic, func, func_mtime = None, bold_suffix = ''):
+    """
+    Build the columnar subject metadata table, phenotypes being stored as
+    typed columns and functional paths as one flat array with row offsets
+
+    Parameters
+    ----------
+    subject_order (list): subject identifiers (sub-XXX) in row order
+    phenotypic (list): participant_id, diagnosis, age and gender of each subject
+    func (list): paths to functional files of each subject
+    func_mtime (list): modification time of the func directory of each subject
+    bold_suffix (str): suffix of bold files used to find functional files
+
+    Returns
+    ----------
+    columns (dict): metadata arrays, as saved in the index file
+    """
+    phen = np.asarray(phenotypic, dtype=str).reshape(-1, 4)
+    diagnoses, diagnosis = np.unique(phen[:, 1], return_inverse=True)
+    genders, gender = np.unique(phen[:, 3], return_inverse=True)
+    age = pd.to_numeric(pd.Series(phen[:, 2]), errors='coerce').fillna(-1).to_numpy()
+
+    columns = {
+        'subjects' : np.asarray(subject_order, dtype=str),
+        'diagnosis' : diagnosis.astype(np.int8),
+        'diagnoses' : diagnoses,
+        'age' : age.astype(np.int16),
+        'gender' : gender.astype(np.int8),
+        'genders' : genders,
+        'func' : np.asarray(sum(func, []), dtype=str),
+        'func_offsets' : np.concatenate([[0], np.cumsum([len(paths) for paths in func])]).astype(np.int64),
+        'func_mtime' : np.asarray(func_mtime if func_mtime is not None else [-1] * len(func), dtype=np.int64),
+        'bold_suffix' : np.asarray(bold_suffix, dtype=str),
+    }
+
+    return columns
 
+def save_index(path, columns):
+    """
+    Atomically save the subject metadata table to the index file
+
+    Parameters
+    ----------
+    path (str): path to top level data directory
+    columns (dict): metadata arrays, as returned by build_index
+    """
+    index_path = os.path.join(path, INDEX_FILE)
+
+    # each writer gets its own temporary file, so concurrent rebuilds do not interleave
+
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(index_path), prefix=f'{INDEX_FILE}.', suffix='.tmp', delete=False) as savefile:
+        np.savez(savefile, **columns)
+    os.replace(savefile.name, index_path)
+
+def load_index(path):
+    """
+    Load the subject metadata table, rebuilding it from format_file.json
+    when the index is missing or older than the JSON file
+
+    Parameters
+    ----------
+    path (str): path to top level data directory
+
+    Returns
+    ----------
+    index (Bunch): metadata arrays, with a subject to row mapping in rows
+    """
+    index_path = os.path.join(path, INDEX_FILE)
+    json_path = os.path.join(path, 'format_file.json')
+
+    index_mtime = get_mtime(index_path)
+    if index_mtime != -1 and index_mtime >= get_mtime(json_path):
+        with np.load(index_path, allow_pickle=False) as saved:
+            columns = dict(saved)
+    else:
+        with open(json_path, 'r') as o:
+            data = json.load(o)
+        columns = build_index(data['subject_order'], data['phenotypic'], data['func'], bold_suffix = data.get('bold_suffix', ''))
+        try:
+            save_index(path, columns)
+        except OSError:
+            pass
+
+    return Bunch(rows = {sub : row for row, sub in enumerate(columns['subjects'].tolist())}, **columns)
 
 def get_format_file(path, bold_suffix):
     """
-    Create and save a JSON file containing relvant subject information
+    Create and save a JSON file and binary index containing relvant subject
+    information, functional files being searched for again only in subject
+    folders that changed since the index was last built
 
     Parameters
     ----------
     path (str): path to top level data directory
     bold_suffix (str): suffix of bold files following identifier
-    confound_suffix (str): suffix of confound (tsv) files following identifier
     """
 
     dirs = get_directories(path)
@@ -62,20 +170,34 @@ def get_format_file(path, bold_suffix):
 
     phenotypes = [pheno.tolist() for index, pheno in participants[['participant_id','diagnosis','age','gender']].iterrows()]
     
+    # reuse the functional files of subjects whose func folder is unchanged
+
+    previous = load_index(path) if os.path.exists(os.path.join(path, INDEX_FILE)) else None
+    reuse = previous is not None and str(previous.bold_suffix) == bold_suffix
+
     func_paths = []
+    func_mtime = []
 
     for dir in dirs:
         path_to_data = os.path.join(dir, 'func')
-        func_paths.append(glob.glob(f'{path_to_data}/*{bold_suffix}*'))
+        mtime = get_mtime(path_to_data)
+        row = previous.rows.get(os.path.basename(dir)) if reuse else None
+        if row is not None and mtime != -1 and previous.func_mtime[row] == mtime:
+            func_paths.append(previous.func[previous.func_offsets[row]:previous.func_offsets[row + 1]].tolist())
+        else:
+            func_paths.append(glob.glob(f'{path_to_data}/*{bold_suffix}*'))
+        func_mtime.append(mtime)
 
     database = {
         'func' : func_paths,
         'phenotypic' : phenotypes,
-        'subject_order' : available_subjects
+        'subject_order' : available_subjects,
+        'bold_suffix' : bold_suffix
     }
 
     with open(f'{path}/format_file.json', 'w') as savefile:
         json.dump(database, savefile)
+    save_index(path, build_index(available_subjects, phenotypes, func_paths, func_mtime, bold_suffix))
 
     return
 
@@ -90,20 +212,26 @@ def load_data(path, subjects = []):
 
     Returns
     ----------
-    data (dict): data for specified subjects
+    data (dict): data for specified subjects, with phenotypes both as a
+    string array and as typed age, diagnosis and gender columns
     """
-    with open(os.path.join(path,'format_file.json'), 'r') as o:
-        data = json.load(o)
+    index = load_index(path)
 
     if subjects:
-        idcs = [data['subject_order'].index(f'sub-{sub}') for sub in subjects]
+        idcs = np.asarray([index.rows[f'sub-{sub}'] for sub in subjects], dtype=int)
     else:
-        idcs = list(range(len(data['subject_order'])))
+        idcs = np.arange(len(index.subjects))
+
+    diagnosis = pd.Categorical.from_codes(index.diagnosis[idcs], index.diagnoses)
+    gender = pd.Categorical.from_codes(index.gender[idcs], index.genders)
 
     data = Bunch(
-        order = [data['subject_order'][sub] for sub in idcs],
-        func = [data['func'][sub] for sub in idcs],
-        phenotypic = np.asarray([data['phenotypic'][sub] for sub in idcs]),
+        order = index.subjects[idcs].tolist(),
+        func = [index.func[index.func_offsets[sub]:index.func_offsets[sub + 1]].tolist() for sub in idcs],
+        phenotypic = np.column_stack([index.subjects[idcs], np.asarray(diagnosis, dtype=str), index.age[idcs].astype(str), np.asarray(gender, dtype=str)]),
+        age = index.age[idcs],
+        diagnosis = diagnosis,
+        gender = gender,
         )
     
     return data
@@ -113,6 +241,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('path_to_data', type=pathlib.Path, help='Path to derivatives directory or equivalent')
     parser.add_argument('bold_suffix', type=str, help='Suffix of preprocessed BOLD files')
+    parser.add_argument('--profile_dir', type=str, help='Directory to write stage timings, memory and reads of this run to', default=None)
     args = parser.parse_args()
-    
-    get_format_file(args.path_to_data, args.bold_suffix)
\ No newline at end of file
+    enable(bool(args.profile_dir))
+
+    with stage('format'):
+        get_format_file(args.path_to_data, args.bold_suffix)
+
+    if args.profile_dir:
+        print(write_profile(args.profile_dir, 'format_data').round(3).to_string())
\ No newline at end of file
@@ -4,29 +4,346 @@
 
 import argparse
 
+import io
 import os
+import sys
 import glob
+import gzip
+import traceback
 import numpy as np
 import nibabel as nib
-from nilearn.maskers import NiftiLabelsMasker
-from nilearn.connectome import ConnectivityMeasure
+from collections import deque
+from itertools import repeat, chain
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from nilearn.interfaces.fmriprep import load_confounds_strategy
-from scripts.format_data import load_data
+from format_data import load_data
+from cache import get_key, file_digest, get_digests, load_manifest, save_manifest, is_current, set_current
+from feature_store import DTYPES, get_store_paths, save_feature_store, encode_features
+from signal_extraction import get_label_matrix, extract_signals, clean_signals
+from connectivity import KINDS, GROUP_KINDS, compute_connectivity
+from profiling import enable, stage, collect, extend, write_profile
+
+CONFOUND_STRATEGY = {'denoise_strategy' : 'simple', 'motion' : 'basic', 'global_signal' : 'basic'}
+MASKER_PARAMS = {'standardize' : True}
+
+# per-process state, set up once by init_worker
+_worker = {}
+
+def init_worker(paths_to_atlases, chunk_size = None, profile = False, prefetch = 0):
+    """
+    Initialize the atlases used by the current process
+
+    Parameters
+    ----------
+    paths_to_atlases (list): paths to atlas files for masking
+    chunk_size (int): number of timepoints read at a time, None to load whole images
+    profile (bool): whether stages of each subject are measured
+    prefetch (int): number of subjects whose inputs are read ahead while the current one is masked
+    """
+    enable(profile)
+    _worker['atlases'] = [nib.load(path) for path in paths_to_atlases]
+    _worker['chunk_size'] = chunk_size
+    _worker['prefetch'] = prefetch
+    _worker['label_matrices'] = {}
+
+def get_label_matrices(img):
+    """
+    Retrieve the region averaging matrix of all atlases resampled to the grid
+    of an image, resampling the atlases only once per grid for the current process
+
+    Parameters
+    ----------
+    img (Nifti1Image): functional image to be masked
+
+    Returns
+    ----------
+    label_matrix (csr_matrix): regions x voxels averaging matrix of all atlases
+    regions (list): atlas labels of the rows belonging to each atlas
+    """
+    grid = (img.shape[:3], img.affine.tobytes())
+    if grid not in _worker['label_matrices']:
+        _worker['label_matrices'][grid] = get_label_matrix(_worker['atlases'], img)
+
+    return _worker['label_matrices'][grid]
+
+def get_atlas_name(path_to_atlas):
+    """
+    Get the name used to namespace outputs of an atlas
+
+    Parameters
+    ----------
+    path_to_atlas (str): path to atlas file
+
+    Returns
+    ----------
+    name (str): atlas file name without extensions
+    """
+    return os.path.basename(path_to_atlas).split('.')[0]
+
+def get_func_path(func_paths, task):
+    """
+    Select the functional file of a subject belonging to a task
+
+    Parameters
+    ----------
+    func_paths (list): paths to all functional files of a subject
+    task (str): functional task to select
+
+    Returns
+    ----------
+    func_path (str): path to functional file of task
+    """
+    return func_paths[np.where(np.char.count(func_paths, f'task-{task}'))[0][0]]
+
+def get_confound_paths(func_path):
+    """
+    Retrieve the fMRIPrep confound files belonging to a functional file
+
+    Parameters
+    ----------
+    func_path (str): path to preprocessed BOLD file
+
+    Returns
+    ----------
+    paths (list): paths to confound TSV and JSON files
+    """
+    prefix = func_path.split('_space-')[0].split('_desc-')[0]
+    return sorted(glob.glob(f'{prefix}_desc-confounds_*'))
+
+def get_subject_inputs(func_paths, task):
+    """
+    Retrieve the input files used in generating the time series of a subject
+
+    Parameters
+    ----------
+    func_paths (list): paths to all functional files of the subject
+    task (str): functional task to get connectivity data for
+
+    Returns
+    ----------
+    paths (list): paths to BOLD and confound files, empty if the task is missing
+    """
+    try:
+        func_path = get_func_path(func_paths, task)
+    except IndexError:
+        return []
+
+    return [func_path, *get_confound_paths(func_path)]
+
+def get_subject_key(inputs, digests, atlas_digest):
+    """
+    Get the cache key of subject time series from its inputs and parameters
+
+    Parameters
+    ----------
+    inputs (list): paths to input files, as returned by get_subject_inputs
+    digests (dict): sha256 digests of input files, as returned by cache.get_digests
+    atlas_digest (str): sha256 digest of the atlas file
+
+    Returns
+    ----------
+    key (str): cache key, None if any input of the subject is missing
+    """
+    try:
+        inputs = [digests[os.path.abspath(path)] for path in inputs]
+    except KeyError:
+        return None
+
+    return get_key(inputs, atlas_digest, MASKER_PARAMS, CONFOUND_STRATEGY) if inputs else None
+
+def get_timeseries_dir(path, path_to_atlas):
+    """
+    Get the directory in which time series of an atlas and confound strategy are cached
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory or equivalent
+    path_to_atlas (str): path to atlas file for masking
+
+    Returns
+    ----------
+    directory (str): path to time series directory
+    """
+    strategy = '_'.join(f'{k}-{v}' for k, v in CONFOUND_STRATEGY.items())
+
+    return os.path.join(os.path.abspath(path), 'timeseries', get_atlas_name(path_to_atlas), strategy)
+
+def load_time_series(path):
+    """
+    Load cached parcel time series of a subject
+
+    Parameters
+    ----------
+    path (str): path to compressed .npz time series file
+
+    Returns
+    ----------
+    time_series (np.array): denoised time series, timepoints x regions
+    """
+    with np.load(path) as saved:
+        return saved['time_series']
+
+def load_subject_inputs(subname, func_paths, task):
+    """
+    Read the functional image and confounds of a subject
+
+    Parameters
+    ----------
+    subname (str): subject identifier
+    func_paths (list): paths to all functional files of the subject
+    task (str): functional task to get connectivity data for
+
+    Returns
+    ----------
+    img (Nifti1Image): functional image, with its data loaded unless streamed
+    confounds (pd.DataFrame): confound regressors, as returned by load_confounds_strategy
+    sample_mask (np.array): indices of timepoints to keep
+    """
+    func_path = get_func_path(func_paths, task)
+
+    # streamed images are only read into memory, still compressed, so that
+    # decompression happens chunk by chunk while masking
+
+    with stage('image_load', subject=subname):
+        if _worker['chunk_size'] and _worker['prefetch']:
+            with open(func_path, 'rb') as o:
+                stream = io.BytesIO(o.read())
+            img = nib.Nifti1Image.from_stream(gzip.GzipFile(fileobj=stream) if func_path.endswith('.gz') else stream)
+        elif _worker['chunk_size']:
+            img = nib.load(func_path, keep_file_open=True)
+        else:
+            img = nib.load(func_path)
+            img.get_fdata()
+
+    with stage('confound_load', subject=subname):
+        conf, sample_mask = load_confounds_strategy(func_path, **CONFOUND_STRATEGY)
+
+    return img, conf, sample_mask
+
+def get_subject_time_series(subname, func_paths, task, inputs = None):
+    """
+    Extract the denoised parcel time series of a single subject for every
+    atlas, loading the image and regressing confounds only once, any error
+    being returned rather than raised so that failures stay isolated to the subject
+
+    Parameters
+    ----------
+    subname (str): subject identifier
+    func_paths (list): paths to all functional files of the subject
+    task (str): functional task to get connectivity data for
+    inputs (Future): pending result of load_subject_inputs, None to read inputs now
+
+    Returns
+    ----------
+    subname (str): subject identifier
+    time_series (list): denoised time series of each atlas, None on failure
+    regions (list): atlas labels of each time series column, None on failure
+    error (str): traceback of failure, None on success
+    records (list): stage measurements of the subject, empty unless profiling
+    """
+    try:
+        if inputs is None:
+            img, conf, sample_mask = load_subject_inputs(subname, func_paths, task)
+        else:
+            with stage('prefetch_wait', subject=subname):
+                img, conf, sample_mask = inputs.result()
+
+        # region signals of all atlases are cleaned together, cleaning being column-wise
+
+        with stage('masking', subject=subname):
+            label_matrix, regions = get_label_matrices(img)
+            signals = clean_signals(extract_signals(img, label_matrix, _worker['chunk_size']), conf, sample_mask, **MASKER_PARAMS)
+            time_series = np.split(signals, np.cumsum([len(r) for r in regions])[:-1], axis=1)
+    except Exception:
+        return subname, None, None, traceback.format_exc(), collect()
+
+    return subname, time_series, regions, None, collect()
+
+def iter_time_series(subnames, func_paths, task):
+    """
+    Extract the time series of subjects in order, the inputs of the next
+    subjects being read by a thread pool while the current subject is masked,
+    so that reads overlap with computation
+
+    Parameters
+    ----------
+    subnames (list): subject identifiers
+    func_paths (list): paths to all functional files of each subject
+    task (str): functional task to get connectivity data for
+
+    Returns
+    ----------
+    results (generator): results of get_subject_time_series for each subject
+    """
+    if not(_worker['prefetch']):
+        yield from map(get_subject_time_series, subnames, func_paths, repeat(task))
+        return
+
+    # at most prefetch subjects are read ahead, bounding the memory held by pending inputs
+
+    subjects = zip(subnames, func_paths)
+    with ThreadPoolExecutor(max_workers=_worker['prefetch']) as loader:
+        pending = deque()
+        for subname, paths in subjects:
+            pending.append((subname, paths, loader.submit(load_subject_inputs, subname, paths, task)))
+            if len(pending) > _worker['prefetch']:
+                subname, paths, inputs = pending.popleft()
+                yield get_subject_time_series(subname, paths, task, inputs)
+        while pending:
+            subname, paths, inputs = pending.popleft()
+            yield get_subject_time_series(subname, paths, task, inputs)
+
+def get_block_time_series(subnames, func_paths, task):
+    """
+    Extract the time series of a block of consecutive subjects in one worker process, prefetching within the block
+
+    Parameters
+    ----------
+    subnames (list): subject identifiers
+    func_paths (list): paths to all functional files of each subject
+    task (str): functional task to get connectivity data for
+
+    Returns
+    ----------
+    results (list): results of get_subject_time_series for each subject
+    """
+    return list(iter_time_series(subnames, func_paths, task))
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('path_to_data', type=str, help='Path to derivatives directory or equivalent')
-    parser.add_argument('path_to_atlas', type=str, help='Path to atlas file for masking')
+    parser.add_argument('path_to_atlas', type=str, nargs='+', help='Path to atlas file(s) for masking, outputs being namespaced per atlas when several are given')
     parser.add_argument('--subjects', help='Path to file or Python list of subjects to get connectivity data for')
     parser.add_argument('--task', type =str, help='Functional task to get connectivity data for', default='rest')
-    parser.add_argument('--connectivity_measure', type=str, help='Metric to use in quantifying connectivity measure', default='correlation')
+    parser.add_argument('--connectivity_measure', type=str, choices=KINDS, help='Metric to use in quantifying connectivity measure', default='correlation')
+    parser.add_argument('--storage_dtype', type=str, choices=DTYPES, help='Dtype connectomes are saved in, int16 quantizing Fisher z-transformed correlations', default='float32')
+    parser.add_argument('--batch_size', type=int, help='Number of subjects whose connectivity is computed at a time', default=256)
+    parser.add_argument('--n_jobs', type=int, help='Number of subjects to process concurrently, -1 to use all cores', default=1)
+    parser.add_argument('--chunk_size', type=int, help='Number of timepoints read at a time, bounding memory use on low-memory nodes', default=None)
+    parser.add_argument('--prefetch', type=int, help='Number of subjects whose images and confounds are read ahead by background threads while masking, whole images being held in memory unless --chunk_size is given', default=0)
+    parser.add_argument('--from_timeseries', action='store_true', help='Use cached time series as they are, without checking or reading functional images')
+    parser.add_argument('--force', action='store_true', help='Recompute time series and connectomes even if they are up to date')
+    parser.add_argument('--timeseries_only', action='store_true', help='Only extract time series, e.g. for one shard of subjects, leaving connectomes and feature stores to a later run over all subjects')
+    parser.add_argument('--profile_dir', type=str, help='Directory to write stage timings, memory and reads of this run to', default=None)
     parser.add_argument('--verbosity', type=int, default=1)
     args = parser.parse_args()
+    enable(bool(args.profile_dir))
+
+    if args.storage_dtype == 'int16' and args.connectivity_measure not in ['correlation', 'partial correlation']:
+        parser.error('The int16 storage dtype only applies to correlations')
 
-    save_to = os.path.join(os.path.abspath(args.path_to_data), 'connectomes')
-    if not(glob.glob(save_to)):
-        os.mkdir(save_to)
+    # a single atlas keeps the flat connectomes directory, several atlases get one subdirectory each
+
+    atlases = args.path_to_atlas
+    names = [get_atlas_name(atlas) for atlas in atlases]
+    if len(set(names)) < len(names):
+        parser.error(f'Atlases must have distinct file names, as their outputs are namespaced by name: {", ".join(sorted(n for n in set(names) if names.count(n) > 1))}')
+    namespaces = names if len(atlases) > 1 else [None]
+    save_to = [os.path.join(os.path.abspath(args.path_to_data), 'connectomes', *([namespace] if namespace else [])) for namespace in namespaces]
+    timeseries_dirs = [get_timeseries_dir(args.path_to_data, atlas) for atlas in atlases]
+    for directory in save_to + timeseries_dirs:
+        os.makedirs(directory, exist_ok=True)
 
     if args.subjects:
         if type(args.subjects) is str:
@@ -41,54 +358,158 @@ if __name__ == '__main__':
         print('Loading subject data...')
 
     data = load_data(args.path_to_data, subjects)
+    n_jobs = os.cpu_count() if args.n_jobs == -1 else max(args.n_jobs, 1)
 
-    if args.verbosity:
-        print('Initializing mask...')
+    # skip subjects whose outputs were derived from identical inputs and parameters,
+    # time series are keyed on inputs, atlas and denoising, connectomes additionally on the measure
 
-    masker = NiftiLabelsMasker(labels_img=args.path_to_atlas, standardize=True)
+    manifest_path = os.path.join(os.path.abspath(args.path_to_data), 'cache_manifest.json')
+    manifest = load_manifest(manifest_path)
 
-    if args.verbosity:
-        print('Initialising connectivity measure...')
+    ts_outputs = [[os.path.join(directory, f'{subname}_{args.task}_timeseries.npz') for subname in data.order] for directory in timeseries_dirs]
+    outputs = [[os.path.join(directory, f'{subname}_{args.task}_connectome.npy') for subname in data.order] for directory in save_to]
+
+    if args.from_timeseries:
+        ts_keys = [[manifest['outputs'].get(os.path.relpath(ts_output, manifest['root'])) if os.path.exists(ts_output) else None for ts_output in atlas_outputs] for atlas_outputs in ts_outputs]
+    else:
+        if args.verbosity:
+            print('Hashing input files...')
 
-    correlation_measure = ConnectivityMeasure(kind=args.connectivity_measure, vectorize=True, discard_diagonal=True)
+        inputs = [get_subject_inputs(func_paths, args.task) for func_paths in data.func]
+        digests = get_digests([*atlases, *sum(inputs, [])], manifest, n_jobs)
+        ts_keys = [[get_subject_key(paths, digests, digests[os.path.abspath(atlas)]) for paths in inputs] for atlas in atlases]
+
+    # group level measures are fitted on all subjects, so their connectomes are also keyed on the time series of the group
+
+    group = args.connectivity_measure in GROUP_KINDS
+    keys = [[get_key(ts_key, args.connectivity_measure, args.storage_dtype, *([get_key(atlas_keys)] if group else [])) if ts_key else None for ts_key in atlas_keys] for atlas_keys in ts_keys]
+    stale = [[args.force or not(is_current(manifest, outputs[a][sub], keys[a][sub])) for a in range(len(atlases))] for sub in range(len(data.func))]
+    todo = [sub for sub in range(len(data.func)) if any(stale[sub])]
+    ts_todo = [] if args.from_timeseries else [sub for sub in todo if args.force or not(all(is_current(manifest, ts_outputs[a][sub], ts_keys[a][sub]) for a in range(len(atlases))))]
+    save_manifest(manifest, manifest_path)
 
     if args.verbosity:
-        print(f'Data for {len(data.func)} subjects loaded, generating correlation matrices...')
+        print(f'Data for {len(data.func)} subjects and {len(atlases)} atlas(es) loaded, {len(data.func) - len(todo)} subjects up to date, extracting {len(ts_todo)} time series using {n_jobs} process(es)...')
+
+    extract = set(ts_todo)
+    order = [data.order[sub] for sub in ts_todo]
+    func = [data.func[sub] for sub in ts_todo]
+
+    # with prefetching, each process gets blocks of consecutive subjects so that it
+    # knows which inputs to read next, blocks spanning a few prefetch windows
+
+    if n_jobs == 1:
+        init_worker(atlases, args.chunk_size, bool(args.profile_dir), args.prefetch)
+        results = iter_time_series(order, func, args.task)
+    else:
+        block = max(1, min(4 * args.prefetch, -(-len(order) // n_jobs)))
+        executor = ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker, initargs=(atlases, args.chunk_size, bool(args.profile_dir), args.prefetch))
+        results = chain.from_iterable(executor.map(get_block_time_series, [order[i:i + block] for i in range(0, len(order), block)], [func[i:i + block] for i in range(0, len(func), block)], repeat(args.task)))
+
+    # results are returned in subject order, so outputs are written deterministically,
+    # subjects with up to date time series keep their cached time series
 
-    for sub in range(len(data.func)):
+    failed = []
+    for sub in todo:
 
         subname = data.order[sub]
 
-        if args.verbosity-1:
-            print('\n')
-            print(f'Subject {subname.split("-")[1]} ({sub+1}/{len(data.func)}):')
+        if sub in extract:
+            _, time_series, regions, error, records = next(results)
+            extend(records)
+        elif all(os.path.exists(ts_outputs[a][sub]) for a in range(len(atlases))):
+            error = None
+        else:
+            error = f'No cached time series found for {subname}'
+
+        if error is not None:
+            failed.append(subname)
+            if args.verbosity:
+                print(f'Subject {subname.split("-")[1]} ({sub+1}/{len(data.func)}) failed:')
+                print(error)
+            continue
+
+        if sub in extract:
+            for a in range(len(atlases)):
+                np.savez_compressed(ts_outputs[a][sub], time_series=time_series[a], regions=regions[a])
+                set_current(manifest, ts_outputs[a][sub], ts_keys[a][sub])
+            save_manifest(manifest, manifest_path)
 
-        func_path = data.func[sub][np.where(np.char.count(data.func[sub], f'task-{args.task}'))[0][0]]
+        if args.verbosity > 1:
+            print(f'Subject {subname.split("-")[1]} ({sub+1}/{len(data.func)}) time series done.')
 
-        if args.verbosity-1:
-            print('Loading nibabel image...')
+    if n_jobs > 1:
+        executor.shutdown()
 
-        img = nib.load(func_path)
+    # connectomes of each atlas are computed in one batched pass over the subjects needing them,
+    # group level measures being fitted once over all subjects with time series
 
-        if args.verbosity-1:
-            print('Loading confounds...')
+    connectome_atlases = [] if args.timeseries_only else range(len(atlases))
 
-        conf, sample_mask = load_confounds_strategy(func_path, denoise_strategy = 'simple', motion = 'basic', global_signal = 'basic')
+    for a in connectome_atlases:
 
-        if args.verbosity-1:
-            print('Fitting mask...')
+        ready = [sub for sub in range(len(data.order)) if data.order[sub] not in failed and os.path.exists(ts_outputs[a][sub])]
+        batch = ready if group else [sub for sub in ready if sub in todo and stale[sub][a]]
+        if not(any(stale[sub][a] for sub in batch)):
+            continue
 
-        time_series = masker.fit_transform(img, confounds=conf, sample_mask=sample_mask)
+        if args.verbosity:
+            print(f'Computing {args.connectivity_measure} connectivity of {len(batch)} subjects for atlas {get_atlas_name(atlases[a])}...')
 
-        if args.verbosity-1:
-            print('Getting correlation matrix...')
+        with stage('timeseries_load', atlas=get_atlas_name(atlases[a])):
+            time_series = [load_time_series(ts_outputs[a][sub]) for sub in batch]
 
-        correlation_matrix = correlation_measure.fit_transform([time_series])[0]
-        np.save(os.path.join(save_to, f'{subname}_{args.task}_connectome'), correlation_matrix, allow_pickle=True)
+        with stage('connectivity', atlas=get_atlas_name(atlases[a])):
+            features = compute_connectivity(time_series, args.connectivity_measure, args.batch_size)
 
-        if args.verbosity-1:
-            print('Done.')
+        with stage('connectome_save', atlas=get_atlas_name(atlases[a])):
+            for row, sub in enumerate(batch):
+                np.save(outputs[a][sub], encode_features(features[row], args.storage_dtype), allow_pickle=False)
+                set_current(manifest, outputs[a][sub], keys[a][sub])
+        save_manifest(manifest, manifest_path)
+
+    # consolidate connectomes of all subjects into the feature store of each atlas, if any have changed
+
+    everyone = load_data(args.path_to_data).order
+
+    for a in connectome_atlases:
+
+        connectomes = [os.path.join(save_to[a], f'{subname}_{args.task}_connectome.npy') for subname in everyone]
+        stored = [sub for sub in range(len(everyone)) if os.path.exists(connectomes[sub])]
+        store_key = get_key([[everyone[sub], manifest['outputs'].get(os.path.relpath(connectomes[sub], manifest['root']))] for sub in stored])
+        store_path = get_store_paths(args.path_to_data, args.task, namespaces[a])[0]
+
+        if stored and not(is_current(manifest, store_path, store_key)):
+
+            if args.verbosity:
+                print(f'Writing feature store for {len(stored)} subjects to {store_path}...')
+
+            with stage('feature_store', atlas=get_atlas_name(atlases[a])):
+                save_feature_store(
+                                args.path_to_data,
+                                args.task,
+                                [everyone[sub] for sub in stored],
+                                [connectomes[sub] for sub in stored],
+                                metadata = {'atlas' : os.path.abspath(atlases[a]), 'atlas_sha256' : file_digest(atlases[a])['sha256'], 'connectivity_measure' : args.connectivity_measure},
+                                atlas = namespaces[a],
+                                dtype = args.storage_dtype
+                )
+            set_current(manifest, store_path, store_key)
+            save_manifest(manifest, manifest_path)
 
     if args.verbosity:
         print('\n')
-        print(f'{len(data.func)} correlation matrices saved to {save_to}.')
\ No newline at end of file
+        print(f'{len(todo) - len(failed)} subjects processed, connectomes saved to {", ".join(save_to)}.')
+        if failed:
+            print(f'{len(failed)} subjects failed: {", ".join(failed)}')
+
+    if args.profile_dir:
+        summary = write_profile(args.profile_dir, 'get_connectivity_data', {'n_jobs' : n_jobs, 'n_subjects' : len(todo)})
+        if args.verbosity:
+            print(f'Stage profile saved to {args.profile_dir}')
+            print(summary.round(3).to_string())
+
+    # a non-zero exit status lets schedulers retry runs in which subjects failed
+
+    if failed:
+        sys.exit(1)
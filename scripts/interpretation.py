@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"functions for mapping svc weights to pairwise connectivity matrices, region importance and brain images"
+
+import argparse
+
+import os
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from itertools import combinations
+from sklearn.utils import Bunch
+from connectivity import SquareView
+from cache import get_key, get_digests, load_manifest, save_manifest, is_current, set_current
+
+__all__ = [
+'LAB_NAMES',
+'load_weights',
+'get_pair_names',
+'get_node_strength',
+'get_region_images',
+'interpret_weights',
+'get_interpretation_paths',
+'save_interpretation',
+'load_interpretation'
+]
+
+LAB_NAMES = {'CONTROL' : 'Control', 'BIPOLAR' : 'Bipolar', 'ADHD' : 'ADHD', 'SCHZ' : 'Schizophrenia'}
+
+def load_weights(path):
+    """
+    Load the weights saved by fit_svm.py
+
+    Parameters
+    ----------
+    path (str): path to svc_<task>_weights.npy
+
+    Returns
+    ----------
+    coef (np.array): weights of each pair of classes, pairs x edges
+    classes (np.array): class labels, in the order of the pairs
+    """
+    coef, classes = np.load(path, allow_pickle=True)
+    return np.asarray(coef, dtype=np.float64), np.asarray(classes)
+
+def get_pair_names(classes):
+    """
+    Name the one-vs-one pairs of classes, in the order of the rows of coef_
+
+    Parameters
+    ----------
+    classes (np.array): class labels
+
+    Returns
+    ----------
+    pairs (list): (first, second) display names of each pair
+    """
+    return [(LAB_NAMES.get(c1, c1), LAB_NAMES.get(c2, c2)) for c1, c2 in combinations([str(c) for c in classes], 2)]
+
+def get_node_strength(matrices):
+    """
+    Get the importance of each region as the sum of the absolute weights of its edges
+
+    Parameters
+    ----------
+    matrices (np.array): symmetric weight matrices with a zero diagonal, (pairs x) regions x regions
+
+    Returns
+    ----------
+    strength (np.array): node strength, (pairs x) regions
+    """
+    return np.abs(matrices).sum(axis=-1)
+
+def get_region_images(values, atlas, regions = None):
+    """
+    Map values of each region onto the voxels of an atlas, all maps being filled in one pass
+
+    Parameters
+    ----------
+    values (np.array): values of each region, maps x regions
+    atlas (Nifti1Image): atlas with integer labels, 0 being background
+    regions (np.array): labels of the regions in the columns of values, the sorted non-zero labels of the atlas if None
+
+    Returns
+    ----------
+    images (Nifti1Image): 4D image with one map per row of values, 0 outside regions
+    """
+    labels = np.asarray(atlas.dataobj).astype(int)
+    regions = np.unique(labels[labels != 0]) if regions is None else np.asarray(regions)
+    values = np.atleast_2d(values)
+    if values.shape[-1] != len(regions):
+        raise ValueError(f'{values.shape[-1]} values per map do not match the {len(regions)} atlas regions')
+
+    # voxels are looked up by their position in the sorted region labels, labels missing from regions staying 0
+
+    order = np.argsort(regions)
+    position = np.clip(np.searchsorted(regions[order], labels), 0, len(regions) - 1)
+    inside = regions[order][position] == labels
+    data = np.zeros((*labels.shape, len(values)), dtype=np.float32)
+    data[inside] = values[:, order[position[inside]]].T
+
+    return nib.Nifti1Image(data, atlas.affine)
+
+def interpret_weights(weights_path, atlas_path):
+    """
+    Compute the weight matrix, node strength and node strength map of every
+    pair of classes at once from saved svc weights and an atlas
+
+    Parameters
+    ----------
+    weights_path (str): path to svc_<task>_weights.npy
+    atlas_path (str): path to the atlas the connectomes were extracted with
+
+    Returns
+    ----------
+    interpretation (Bunch): classes, pair names, region labels, weight matrices of each
+    pair as a lazy SquareView, pairs x regions node strength and 4D node strength image
+    """
+    coef, classes = load_weights(weights_path)
+    atlas = nib.load(atlas_path)
+    labels = np.asarray(atlas.dataobj)
+    regions = np.unique(labels[labels != 0])
+
+    # the square matrix of a pair is only built when it is read, one pair at a time
+
+    matrices = SquareView(coef)
+    strength = np.stack([get_node_strength(matrix) for matrix in matrices])
+    if strength.shape[-1] != len(regions):
+        raise ValueError(f'Weights of {strength.shape[-1]} regions do not match the {len(regions)} regions of {atlas_path}')
+
+    return Bunch(
+        classes = classes,
+        pairs = get_pair_names(classes),
+        regions = regions,
+        matrices = matrices,
+        node_strength = strength,
+        images = get_region_images(strength, atlas, regions),
+        )
+
+def get_interpretation_paths(directory, weights_path, atlas_path):
+    """
+    Get the paths of the interpretation outputs of a model and atlas
+
+    Parameters
+    ----------
+    directory (str): directory to save interpretations to
+    weights_path (str): path to svc_<task>_weights.npy
+    atlas_path (str): path to atlas file
+
+    Returns
+    ----------
+    paths (Bunch): paths to .npz arrays, node strength TSV and node strength NIfTI
+    """
+    stem = os.path.join(os.path.abspath(directory), f'{os.path.basename(weights_path).split(".")[0].replace("_weights", "")}_{os.path.basename(atlas_path).split(".")[0]}')
+    return Bunch(arrays = f'{stem}_interpretation.npz', table = f'{stem}_node_strength.tsv', image = f'{stem}_node_strength.nii.gz')
+
+def save_interpretation(interpretation, paths):
+    """
+    Save weights, node strength and node strength maps, weights being kept
+    vectorized and read back as square matrices by load_interpretation
+
+    Parameters
+    ----------
+    interpretation (Bunch): interpretation, as returned by interpret_weights
+    paths (Bunch): output paths, as returned by get_interpretation_paths
+    """
+    names = [f'{dis1}_vs_{dis2}' for dis1, dis2 in interpretation.pairs]
+
+    np.savez(
+        paths.arrays,
+        classes = interpretation.classes.astype(str),
+        pairs = np.asarray(names),
+        regions = interpretation.regions,
+        weights = np.asarray(interpretation.matrices.vectors, dtype=np.float32),
+        node_strength = interpretation.node_strength,
+        )
+    pd.DataFrame(interpretation.node_strength.T, index=pd.Index(interpretation.regions, name='region'), columns=names).to_csv(paths.table, sep='\t')
+    nib.save(interpretation.images, paths.image)
+
+def load_interpretation(path):
+    """
+    Load interpretation arrays saved by save_interpretation
+
+    Parameters
+    ----------
+    path (str): path to .npz arrays
+
+    Returns
+    ----------
+    interpretation (Bunch): classes, pair names, region labels, weight matrices as a SquareView and node strength
+    """
+    with np.load(path, allow_pickle=False) as saved:
+        interpretation = Bunch(**{k : saved[k] for k in saved.files})
+    interpretation.matrices = SquareView(interpretation.pop('weights'))
+
+    return interpretation
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('weights', type=str, nargs='+', help='Path(s) to svc weights saved by fit_svm.py')
+    parser.add_argument('--atlas', type=str, nargs='+', help='Path to the atlas of each weights file, or one atlas for all of them', required=True)
+    parser.add_argument('--output', type=str, help='Directory to save interpretations to, interpretation next to the first weights file by default', default=None)
+    parser.add_argument('--force', action='store_true', help='Recompute interpretations even if their inputs are unchanged')
+    parser.add_argument('--verbosity', type=int, default=1)
+    args = parser.parse_args()
+
+    if len(args.atlas) not in [1, len(args.weights)]:
+        parser.error('Give one atlas, or one atlas per weights file')
+    atlases = args.atlas * len(args.weights) if len(args.atlas) == 1 else args.atlas
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(args.weights[0])), 'interpretation')
+    os.makedirs(output, exist_ok=True)
+
+    # interpretations are keyed on the contents of the weights, atlas and this script
+
+    manifest_path = os.path.join(output, 'cache_manifest.json')
+    manifest = load_manifest(manifest_path)
+    digests = get_digests([__file__, *args.weights, *atlases], manifest)
+
+    done = 0
+    for weights_path, atlas_path in zip(args.weights, atlases):
+        paths = get_interpretation_paths(output, weights_path, atlas_path)
+        key = get_key([digests[os.path.abspath(path)] for path in [__file__, weights_path, atlas_path]])
+        if not(args.force) and all(is_current(manifest, path, key) for path in paths.values()):
+            continue
+
+        save_interpretation(interpret_weights(weights_path, atlas_path), paths)
+        for path in paths.values():
+            set_current(manifest, path, key)
+        save_manifest(manifest, manifest_path)
+        done += 1
+
+        if args.verbosity > 1:
+            print(f'Interpretation of {weights_path} with {atlas_path} done.')
+
+    if args.verbosity:
+        print(f'{len(args.weights) - done} interpretations up to date, {done} computed, saved to {output}.')
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"functions for saving fitted models with the specification of the features they were fitted on"
+
+import os
+import json
+import time
+import joblib
+import warnings
+import sklearn
+from feature_store import load_feature_store
+from cache import get_key, file_digest
+
+__all__ = [
+'get_model_paths',
+'get_feature_spec',
+'check_feature_spec',
+'save_model',
+'load_model'
+]
+
+def get_model_paths(results, task = 'rest', file_suffix = ''):
+    """
+    Get the paths of a model artifact and its metadata sidecar
+
+    Parameters
+    ----------
+    results (str): path to results directory
+    task (str): functional task of the connectivity data
+    file_suffix (str): suffix of saved output files
+
+    Returns
+    ----------
+    model_path (str): path to joblib file of the fitted estimator
+    meta_path (str): path to JSON metadata sidecar
+    """
+    stem = os.path.join(os.path.abspath(results), f'svc_{task}_model{file_suffix}')
+    return f'{stem}.joblib', f'{stem}.json'
+
+def get_feature_spec(path, task = 'rest', atlas = None, n_edges = None):
+    """
+    Describe the features of a derivatives directory, models only applying
+    to features with the same atlas, connectivity measure and number of edges
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory or equivalent
+    task (str): functional task of the connectivity data
+    atlas (str): atlas namespace of connectivity data, None for the top level connectomes directory
+    n_edges (int): number of edges, taken from the feature store if None
+
+    Returns
+    ----------
+    spec (dict): atlas digest, connectivity measure and number of edges, None where unknown
+    """
+    store = load_feature_store(path, task, atlas)
+    meta = store.metadata if store else {}
+
+    # stores written before atlas digests were recorded are identified by their atlas file, if it still exists
+
+    atlas_sha256 = meta.get('atlas_sha256')
+    if atlas_sha256 is None and os.path.exists(meta.get('atlas', '')):
+        atlas_sha256 = file_digest(meta['atlas'])['sha256']
+
+    return {
+        'atlas_sha256' : atlas_sha256,
+        'connectivity_measure' : meta.get('connectivity_measure'),
+        'n_edges' : n_edges if n_edges is not None else meta.get('n_edges'),
+    }
+
+def check_feature_spec(spec, expected):
+    """
+    Check that features match those a model was fitted on, fields unknown on either side being skipped
+
+    Parameters
+    ----------
+    spec (dict): specification of the features, as returned by get_feature_spec
+    expected (dict): specification of the features the model was fitted on
+    """
+    mismatches = [f'{field} is {spec.get(field)}, model expects {value}' for field, value in expected.items() if value is not None and spec.get(field) is not None and spec[field] != value]
+    if mismatches:
+        raise ValueError(f'Features do not match the model: {"; ".join(mismatches)}')
+
+def save_model(results, estimator, spec, task = 'rest', file_suffix = '', metadata = {}):
+    """
+    Save a fitted estimator, e.g. scaler and classifier pipeline, alongside a
+    sidecar holding its label order, feature specification and metadata
+
+    Parameters
+    ----------
+    results (str): path to results directory
+    estimator (BaseEstimator): fitted estimator
+    spec (dict): specification of the features, as returned by get_feature_spec
+    task (str): functional task of the connectivity data
+    file_suffix (str): suffix of saved output files
+    metadata (dict): additional JSON serializable metadata, e.g. hyperparameters
+
+    Returns
+    ----------
+    meta (dict): metadata written to the sidecar
+    """
+    model_path, meta_path = get_model_paths(results, task, file_suffix)
+
+    meta = {
+        **metadata,
+        'task' : task,
+        'classes' : [str(c) for c in estimator.classes_],
+        'n_features' : int(estimator.n_features_in_),
+        'feature_spec' : spec,
+        'feature_spec_key' : get_key(spec),
+        'sklearn_version' : sklearn.__version__,
+        'date' : time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+    joblib.dump(estimator, f'{model_path}.tmp')
+    with open(f'{meta_path}.tmp', 'w') as savefile:
+        json.dump(meta, savefile, indent=4)
+    os.replace(f'{model_path}.tmp', model_path)
+    os.replace(f'{meta_path}.tmp', meta_path)
+
+    return meta
+
+def load_model(model_path):
+    """
+    Load a model saved by save_model
+
+    Parameters
+    ----------
+    model_path (str): path to joblib file of the fitted estimator
+
+    Returns
+    ----------
+    estimator (BaseEstimator): fitted estimator
+    meta (dict): metadata of the sidecar
+    """
+    with open(f'{os.path.splitext(model_path)[0]}.json', 'r') as o:
+        meta = json.load(o)
+
+    if meta['sklearn_version'] != sklearn.__version__:
+        warnings.warn(f'Model was saved with scikit-learn {meta["sklearn_version"]}, loading it with {sklearn.__version__}')
+
+    return joblib.load(model_path), meta
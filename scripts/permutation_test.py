@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"functions for assessing classifier significance by permutation testing"
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.base import clone
+from sklearn.preprocessing import StandardScaler
+
+__all__ = [
+'scale_folds',
+'permutation_test'
+]
+
+# per-process state, set up once by init_permutation_worker
+_permutation = {}
+
+def scale_folds(X, splits, transformer = None):
+    """
+    Standardize the features of each cross-validation fold once, scalers
+    being fitted on the training subjects of the fold
+
+    Parameters
+    ----------
+    X (np.array): features, subjects x features
+    splits (list): train and validation indices of each fold
+    transformer (TransformerMixin): unsupervised transformer replacing the scaler, e.g. scaling and PCA
+
+    Returns
+    ----------
+    folds (list): scaled training features, scaled validation features,
+    training indices and validation indices of each fold
+    """
+    folds = []
+    for train, test in splits:
+        scaler = clone(transformer).fit(X[train]) if transformer is not None else StandardScaler().fit(X[train])
+        folds.append((scaler.transform(X[train]), scaler.transform(X[test]), train, test))
+
+    return folds
+
+def init_permutation_worker(folds, classifier):
+    """
+    Initialize the scaled folds and classifier used by the current process
+
+    Parameters
+    ----------
+    folds (list): scaled folds, as returned by scale_folds
+    classifier (BaseEstimator): unfitted classifier with fixed hyperparameters
+    """
+    _permutation.update(folds = folds, classifier = classifier)
+
+def score_labels(labels):
+    """
+    Get the mean cross-validated accuracy of the classifier for each set of labels
+
+    Parameters
+    ----------
+    labels (np.array): label sets to score, permutations x subjects
+
+    Returns
+    ----------
+    scores (np.array): mean validation accuracy of each label set
+    """
+    scores = np.zeros(len(labels))
+    for k, y in enumerate(labels):
+        for X_train, X_test, train, test in _permutation['folds']:
+            scores[k] += clone(_permutation['classifier']).fit(X_train, y[train]).score(X_test, y[test])
+
+    return scores / len(_permutation['folds'])
+
+def permutation_test(X, y, classifier, splits, n_permutations = 1000, batch_size = 50, n_jobs = 1, seed = None, transformer = None):
+    """
+    Test whether a classifier performs above chance by refitting it on
+    permuted labels, keeping its hyperparameters, scaled features and fold
+    splits fixed, permutations being scored in batches over a process pool
+
+    Parameters
+    ----------
+    X (np.array): features, subjects x features
+    y (np.array): class labels
+    classifier (BaseEstimator): unfitted classifier with fixed hyperparameters
+    splits (list): train and validation indices of each fold
+    n_permutations (int): number of label permutations
+    batch_size (int): number of permutations scored per task
+    n_jobs (int): number of processes, -1 to use all cores
+    seed (int): seed of label permutations
+    transformer (TransformerMixin): unsupervised transformer fitted once per fold instead of the scaler
+
+    Returns
+    ----------
+    score (float): mean cross-validated accuracy with true labels
+    null (np.array): mean cross-validated accuracy of each permutation
+    p_value (float): fraction of permutations scoring at least as well as the true labels
+    """
+    folds = scale_folds(np.asarray(X), splits, transformer)
+    y = np.asarray(y)
+    rng = np.random.default_rng(seed)
+    permutations = np.asarray([rng.permutation(y) for _ in range(n_permutations)])
+    batches = [permutations[i:i + batch_size] for i in range(0, n_permutations, batch_size)]
+    n_jobs = os.cpu_count() if n_jobs == -1 else max(n_jobs, 1)
+
+    init_permutation_worker(folds, classifier)
+    score = score_labels([y])[0]
+
+    if n_jobs == 1:
+        null = np.concatenate(list(map(score_labels, batches)))
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs, initializer = init_permutation_worker, initargs = (folds, classifier)) as executor:
+            null = np.concatenate(list(executor.map(score_labels, batches)))
+
+    p_value = (np.count_nonzero(null >= score) + 1) / (n_permutations + 1)
+
+    return score, null, p_value
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+"script for running the pipeline from formatting to figures as a task graph on a local or distributed scheduler"
+
+import argparse
+
+import os
+import sys
+import json
+import runpy
+import subprocess
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from sklearn.utils import Bunch
+from format_data import get_directories, load_data
+from cache import get_key
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+class SyncExecutor:
+    """
+    Executor running each task in the calling process as soon as it is
+    submitted, so that task graphs can be run and debugged without workers
+    """
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def shutdown(self, wait = True):
+        pass
+
+def run_task(script, args, in_process = False):
+    """
+    Run a pipeline script with command line arguments, either as its own
+    process or in the current process
+
+    Parameters
+    ----------
+    script (str): file name of script in the scripts directory
+    args (list): command line arguments of the script
+    in_process (bool): whether to run the script in the current process
+
+    Returns
+    ----------
+    script (str): file name of the script that ran
+    """
+    path = os.path.join(SCRIPTS, script)
+
+    if in_process:
+        argv = sys.argv
+        sys.argv = [path, *args]
+        try:
+            runpy.run_path(path, run_name='__main__')
+        except SystemExit as exit:
+            if exit.code not in [None, 0]:
+                raise RuntimeError(f'{script} exited with status {exit.code}')
+        finally:
+            sys.argv = argv
+    else:
+        result = subprocess.run([sys.executable, path, *args], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode:
+            raise RuntimeError(f'{script} exited with status {result.returncode}:\n{result.stderr[-5000:]}')
+
+    return script
+
+def get_stats(paths):
+    """
+    Get the size and modification time of files, a cheap signature of task inputs
+
+    Parameters
+    ----------
+    paths (list): paths to files
+
+    Returns
+    ----------
+    stats (list): path, size and modification time in nanoseconds of each existing file
+    """
+    stats = []
+    for path in sorted(paths):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats.append([path, stat.st_size, stat.st_mtime_ns])
+
+    return stats
+
+def get_subject_files(path, subname):
+    """
+    Get the files of the func folder of a subject
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory or equivalent
+    subname (str): subject identifier (sub-XXX)
+
+    Returns
+    ----------
+    paths (list): paths to functional files and confounds of the subject
+    """
+    func = os.path.join(path, subname, 'func')
+    return [os.path.join(func, f) for f in os.listdir(func)] if os.path.isdir(func) else []
+
+def get_tasks(path, atlases, bold_suffix = None, n_shards = 1, measure = 'correlation', storage_dtype = 'float32', chunk_size = None, prefetch = 0, fit_args = [], plots = False, results = None, work_dir = None):
+    """
+    Build the task graph of the pipeline, time series extraction being split
+    into shards of subjects followed by one connectivity task over all subjects
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory or equivalent
+    atlases (list): paths to atlas files for masking
+    bold_suffix (str): suffix of preprocessed BOLD files, None if the data is already formatted
+    n_shards (int): number of time series extraction tasks
+    measure (str): connectivity measure
+    storage_dtype (str): dtype connectomes are saved in
+    chunk_size (int): number of timepoints read at a time, None to load whole images
+    prefetch (int): number of subjects whose inputs are read ahead while masking
+    fit_args (list): additional command line arguments of fit_svm
+    plots (bool): whether to build figures
+    results (str): path to results directory of figures
+    work_dir (str): directory to write subject shard files to
+
+    Returns
+    ----------
+    tasks (list): one Bunch per task with its name, script, arguments, dependencies
+    and input files, the size and modification time of which are part of its key
+    """
+    def task(name, script, args, deps = [], inputs = []):
+        return Bunch(name = name, script = script, args = [str(arg) for arg in args], deps = deps, inputs = list(inputs))
+
+    if bold_suffix:
+        subjects = [os.path.basename(directory) for directory in get_directories(path)]
+        tasks = [task('format', 'format_data.py', [path, bold_suffix], inputs = [os.path.join(path, 'participants.tsv'), *[os.path.join(path, sub, 'func') for sub in subjects]])]
+    else:
+        subjects = load_data(path).order
+        tasks = []
+
+    # subjects are split into contiguous shards, written to files as expected by --subjects
+
+    os.makedirs(work_dir, exist_ok=True)
+    shards = []
+    for k, shard in enumerate(np.array_split(np.asarray(subjects), min(n_shards, len(subjects)))):
+        shard_file = os.path.join(work_dir, f'shard-{k}.txt')
+        with open(shard_file, 'w') as savefile:
+            savefile.write('\n'.join(sub.split('-')[1] for sub in shard))
+        shards.append(task(f'timeseries-{k}', 'get_connectivity_data.py', [path, *atlases, '--subjects', shard_file, '--timeseries_only', *(['--chunk_size', chunk_size] if chunk_size else []), *(['--prefetch', prefetch] if prefetch else []), '--verbosity', 0], [t.name for t in tasks], sum([get_subject_files(path, sub) for sub in shard], [])))
+    tasks += shards
+
+    tasks.append(task('connectivity', 'get_connectivity_data.py', [path, *atlases, '--connectivity_measure', measure, '--storage_dtype', storage_dtype, '--verbosity', 0], [t.name for t in shards], atlases))
+
+    # one model per atlas namespace, as written by get_connectivity_data
+
+    names = [os.path.basename(atlas).split('.')[0] for atlas in atlases] if len(atlases) > 1 else [None]
+    for name in names:
+        atlas_args = ['--atlas', name, '--file_suffix', f'_{name}'] if name else []
+        tasks.append(task(f'fit-{name}' if name else 'fit', 'fit_svm.py', [path, *atlas_args, *fit_args, '--verbosity', 0], ['connectivity']))
+
+    # figures of each atlas only wait for the model fitted on it
+
+    if plots:
+        for name, atlas in zip(names, atlases):
+            tasks.append(task(f'plots-{name}' if name else 'plots', 'data_visualization.py', ['--path', path, '--results', results, '--atlas', atlas, *(['--namespace', name] if name else []), '--verbosity', 0], [f'fit-{name}' if name else 'fit']))
+
+    return tasks
+
+def run_graph(tasks, executor, state, state_path, retries = 0, in_process = False, force = False, verbosity = 1):
+    """
+    Run a task graph, submitting each task once its dependencies succeeded,
+    retrying failed tasks and skipping tasks that already succeeded with the
+    same arguments unless one of their dependencies ran again
+
+    Parameters
+    ----------
+    tasks (list): tasks, as returned by get_tasks
+    executor (Executor): executor running tasks
+    state (dict): keys of tasks that succeeded in previous runs
+    state_path (str): path to JSON file to save state to
+    retries (int): number of times a failing task is resubmitted
+    in_process (bool): whether scripts run in the worker process rather than their own
+    force (bool): whether to run tasks that already succeeded
+    verbosity (int): verbosity of progress messages
+
+    Returns
+    ----------
+    failed (dict): traceback or reason of each task that failed
+    """
+    pending = {t.name : t for t in tasks}
+    done, ran, failed, running = set(), set(), {}, {}
+
+    def submit(t):
+        running[executor.submit(run_task, t.script, t.args, in_process)] = t
+
+    while pending or running:
+
+        n_pending = len(pending)
+        for name, t in list(pending.items()):
+            if any(dep in failed for dep in t.deps):
+                failed[name] = f'Dependency {", ".join(dep for dep in t.deps if dep in failed)} failed'
+                del pending[name]
+            elif all(dep in done for dep in t.deps):
+                del pending[name]
+                t.key, t.attempt = get_key(t.script, t.args, get_stats(t.inputs)), 0
+                if not(force) and state.get(name) == t.key and not(any(dep in ran for dep in t.deps)):
+                    done.add(name)
+                    if verbosity > 1:
+                        print(f'Task {name} up to date.')
+                else:
+                    submit(t)
+
+        if not(running):
+            if len(pending) == n_pending:
+                raise ValueError(f'Tasks {", ".join(pending)} depend on tasks missing from the graph')
+            continue
+
+        finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in finished:
+            t = running.pop(future)
+            try:
+                future.result()
+            except Exception as error:
+                t.attempt += 1
+                if t.attempt <= retries:
+                    if verbosity:
+                        print(f'Task {t.name} failed, retrying ({t.attempt}/{retries})...')
+                    submit(t)
+                else:
+                    failed[t.name] = str(error)
+                    state.pop(t.name, None)
+                    if verbosity:
+                        print(f'Task {t.name} failed:')
+                        print(error)
+                continue
+
+            done.add(t.name)
+            ran.add(t.name)
+            state[t.name] = t.key
+            with open(f'{state_path}.tmp', 'w') as savefile:
+                json.dump(state, savefile)
+            os.replace(f'{state_path}.tmp', state_path)
+
+            if verbosity:
+                print(f'Task {t.name} done.')
+
+    return failed
+
+def get_executor(scheduler, n_workers = 1, address = None):
+    """
+    Initialize the executor of a scheduler
+
+    Parameters
+    ----------
+    scheduler (str): sync runs tasks one at a time in this process, processes
+    runs each task as its own process, dask submits tasks to a dask cluster
+    n_workers (int): number of tasks run concurrently by local schedulers
+    address (str): address of the dask scheduler, a local cluster if None
+
+    Returns
+    ----------
+    executor (Executor): executor running tasks
+    in_process (bool): whether scripts run in the worker process rather than their own
+    """
+    if scheduler == 'sync':
+        return SyncExecutor(), True
+    elif scheduler == 'processes':
+        return ThreadPoolExecutor(max_workers=n_workers), False
+    elif scheduler == 'dask':
+        try:
+            from dask.distributed import Client
+        except ImportError:
+            raise ImportError('The dask scheduler requires dask.distributed, install it with pip install "dask[distributed]"')
+        client = Client(address) if address else Client(n_workers=n_workers, threads_per_worker=1)
+        return client.get_executor(pure=False), False
+
+    raise ValueError(f'Unknown scheduler {scheduler}')
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help='Path to derivatives directory or equivalent')
+    parser.add_argument('path_to_atlas', type=str, nargs='+', help='Path to atlas file(s) for masking')
+    parser.add_argument('--bold_suffix', type=str, help='Suffix of preprocessed BOLD files, formats the data first when given', default=None)
+    parser.add_argument('--connectivity_measure', type=str, help='Metric to use in quantifying connectivity measure', default='correlation')
+    parser.add_argument('--storage_dtype', type=str, help='Dtype connectomes are saved in', default='float32')
+    parser.add_argument('--chunk_size', type=int, help='Number of timepoints read at a time', default=None)
+    parser.add_argument('--prefetch', type=int, help='Number of subjects whose inputs are read ahead while masking', default=0)
+    parser.add_argument('--fit_args', type=str, nargs=argparse.REMAINDER, help='Additional arguments of fit_svm, e.g. --nested --outer_jobs 4', default=[])
+    parser.add_argument('--plots', action='store_true', help='Build figures once models are fitted')
+    parser.add_argument('--results', type=str, help='Path to results directory of figures, the results directory fit_svm saves models to by default', default=None)
+    parser.add_argument('--scheduler', type=str, choices=['sync', 'processes', 'dask'], help='Scheduler running tasks', default='processes')
+    parser.add_argument('--address', type=str, help='Address of a running dask scheduler, a local cluster is started if not given', default=None)
+    parser.add_argument('--n_workers', type=int, help='Number of tasks run concurrently by local schedulers, -1 to use all cores', default=1)
+    parser.add_argument('--shards', type=int, help='Number of time series extraction tasks, the number of workers by default', default=None)
+    parser.add_argument('--retries', type=int, help='Number of times a failing task is resubmitted', default=1)
+    parser.add_argument('--force', action='store_true', help='Run tasks that already succeeded with the same arguments')
+    parser.add_argument('--verbosity', type=int, default=1)
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.path)
+    n_workers = os.cpu_count() if args.n_workers == -1 else max(args.n_workers, 1)
+    work_dir = os.path.join(path, 'pipeline')
+
+    tasks = get_tasks(
+                    path,
+                    [os.path.abspath(atlas) for atlas in args.path_to_atlas],
+                    bold_suffix = args.bold_suffix,
+                    n_shards = args.shards or n_workers,
+                    measure = args.connectivity_measure,
+                    storage_dtype = args.storage_dtype,
+                    chunk_size = args.chunk_size,
+                    prefetch = args.prefetch,
+                    fit_args = args.fit_args,
+                    plots = args.plots,
+                    results = os.path.abspath(args.results) if args.results else os.path.join('/'.join(path.split('/')[:-2]), 'results'),
+                    work_dir = work_dir
+    )
+
+    # tasks that succeeded are recorded, so that rerunning the pipeline only runs failed and downstream tasks
+
+    state_path = os.path.join(work_dir, 'state.json')
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as o:
+            state = json.load(o)
+
+    if args.verbosity:
+        print(f'Running {len(tasks)} tasks with the {args.scheduler} scheduler...')
+
+    executor, in_process = get_executor(args.scheduler, n_workers, args.address)
+    failed = run_graph(tasks, executor, state, state_path, args.retries, in_process, args.force, args.verbosity)
+    executor.shutdown()
+
+    if args.verbosity:
+        print(f'{len(tasks) - len(failed)} tasks succeeded.')
+        if failed:
+            print(f'{len(failed)} tasks failed: {", ".join(failed)}, rerun to retry them')
+
+    if failed:
+        sys.exit(1)
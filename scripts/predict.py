@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"script for classifying subjects with a model saved by fit_svm.py"
+
+import argparse
+
+import os
+import numpy as np
+import pandas as pd
+from format_data import load_data
+from fit_svm import get_model_input
+from model_store import get_feature_spec, check_feature_spec, load_model
+from profiling import enable, stage, write_profile
+
+def predict_subjects(estimator, features):
+    """
+    Classify subjects, scaling and decision values being computed once for all
+    subjects and predictions derived from decision values as done by SVC
+
+    Parameters
+    ----------
+    estimator (BaseEstimator): fitted estimator, e.g. scaler and classifier pipeline
+    features (np.array): features, subjects x features
+
+    Returns
+    ----------
+    predictions (np.array): predicted class labels
+    decision (np.array): subjects x classes decision values, subjects x 1 for binary problems
+    """
+    decision = estimator.decision_function(features)
+    classes = estimator.classes_
+
+    # multiclass decisions are one-vs-one votes plus confidences below 1/3, so
+    # rounding recovers the votes and argmax breaks ties towards the first class, as libsvm does
+
+    if len(classes) == 2:
+        predictions = classes[(decision > 0).astype(int)]
+    else:
+        predictions = classes[np.argmax(np.rint(decision), axis=1)]
+
+    return predictions, decision.reshape(len(features), -1)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help='Path to derivatives directory or equivalent')
+    parser.add_argument('model', type=str, help='Path to model saved by fit_svm.py (svc_<task>_model.joblib)')
+    parser.add_argument('--subjects', help='Path to file or Python list of subjects to classify, all subjects by default', default=[])
+    parser.add_argument('--atlas', type=str, help='Atlas namespace of connectivity data, the namespace the model was fitted on by default', default=None)
+    parser.add_argument('--output', type=str, help='Path to TSV file of predictions, next to the model by default', default=None)
+    parser.add_argument('--profile_dir', type=str, help='Directory to write stage timings, memory and reads of this run to', default=None)
+    parser.add_argument('--verbosity', type=int, default=1)
+    args = parser.parse_args()
+    enable(bool(args.profile_dir))
+
+    if args.subjects:
+        if type(args.subjects) is str:
+            with open(args.subjects) as subs:
+                subjects = [s.strip('\n') for s in subs.readlines()]
+        else:
+            subjects = args.subjects
+    else:
+        subjects = []
+
+    with stage('load_model'):
+        estimator, meta = load_model(args.model)
+    atlas = args.atlas or meta.get('atlas')
+    output = args.output or f'{os.path.splitext(os.path.abspath(args.model))[0].replace("_model", "_predictions", 1)}.tsv'
+
+    if args.verbosity:
+        print('Loading subject data...')
+
+    with stage('load_features'):
+        features, diagnosis = get_model_input(args.path, meta['task'], subjects, [], atlas)
+    check_feature_spec(get_feature_spec(args.path, meta['task'], atlas, features.shape[1]), meta['feature_spec'])
+
+    if args.verbosity:
+        print(f'Classifying {len(features)} subjects...')
+
+    with stage('predict', n_subjects=len(features)):
+        predictions, decision = predict_subjects(estimator, features)
+
+    # true diagnoses are kept alongside predictions when known, e.g. for held out subjects
+
+    order = load_data(args.path, subjects).order
+    columns = ['decision'] if decision.shape[1] == 1 else [f'decision_{c}' for c in estimator.classes_]
+    results = pd.DataFrame(decision, columns=columns, index=pd.Index(order, name='participant_id'))
+    results.insert(0, 'prediction', predictions)
+    results.insert(1, 'diagnosis', diagnosis)
+    results.to_csv(output, sep='\t')
+
+    if args.verbosity:
+        known = np.isin(diagnosis, estimator.classes_)
+        if known.any():
+            print(f'Accuracy on {np.count_nonzero(known)} subjects with known diagnosis: {np.mean(predictions[known] == diagnosis[known]):.3f}')
+        print(f'Predictions saved to {output}')
+
+    if args.profile_dir:
+        summary = write_profile(args.profile_dir, 'predict', {'n_subjects' : len(features)})
+        if args.verbosity:
+            print(f'Stage profile saved to {args.profile_dir}')
+            print(summary.round(3).to_string())
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+"functions for recording the wall time, CPU time, memory and reads of pipeline stages"
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import pandas as pd
+from contextlib import contextmanager
+
+__all__ = [
+'enable',
+'stage',
+'collect',
+'extend',
+'summarize',
+'write_profile'
+]
+
+# per-process state, stages are only measured once enable is called, records
+# being guarded by a lock as helper threads add to them while the main thread collects
+_profile = {'enabled' : False, 'records' : [], 'lock' : threading.Lock()}
+
+def enable(enabled = True):
+    """
+    Turn stage measurements on or off for the current process
+
+    Parameters
+    ----------
+    enabled (bool): whether stages are measured
+    """
+    _profile['enabled'] = enabled
+
+def read_bytes(thread = False):
+    """
+    Get the number of bytes read by the current process, including reads served from the page cache
+
+    Parameters
+    ----------
+    thread (bool): whether to count only the reads of the calling thread
+
+    Returns
+    ----------
+    rchar (int): bytes read so far, None if /proc is unavailable
+    """
+    try:
+        with open('/proc/thread-self/io' if thread else '/proc/self/io', 'r') as o:
+            for line in o:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process, where the kernel allows it
+
+    Returns
+    ----------
+    reset (bool): whether the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as o:
+            o.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss():
+    """
+    Get the peak resident set size of the current process
+
+    Returns
+    ----------
+    peak (int): peak resident set size in bytes
+    """
+    try:
+        with open('/proc/self/status', 'r') as o:
+            for line in o:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+@contextmanager
+def stage(name, **info):
+    """
+    Measure a stage of the pipeline, recording its wall time, CPU time of the
+    process and of its terminated children, peak resident set size and bytes read
+
+    Stages of helper threads, e.g. prefetching inputs, only record the CPU time
+    and reads of their own thread, and neither reset nor report the peak resident
+    set size, which belongs to the stage the main thread is running meanwhile.
+    Stages of the main thread still measure the whole process, helper threads included
+
+    Parameters
+    ----------
+    name (str): name of stage
+    info: additional JSON serializable fields of the record, e.g. subject
+    """
+    if not(_profile['enabled']):
+        yield
+        return
+
+    helper = threading.current_thread() is not threading.main_thread()
+    reset = False if helper else reset_peak_rss()
+    start_bytes = read_bytes(helper)
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_thread = time.thread_time()
+    start = time.time()
+    start_wall = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        end_self = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        end_thread = time.thread_time()
+        end_bytes = read_bytes(helper)
+
+        record = {
+            'stage' : name,
+            **info,
+            'pid' : os.getpid(),
+            'start' : start,
+            'wall_s' : wall,
+            'cpu_s' : end_thread - start_thread if helper else (end_self.ru_utime - start_self.ru_utime) + (end_self.ru_stime - start_self.ru_stime),
+            'children_cpu_s' : None if helper else (end_children.ru_utime - start_children.ru_utime) + (end_children.ru_stime - start_children.ru_stime),
+            'peak_rss_mb' : None if helper else peak_rss() / 2**20,
+            'peak_rss_is_stage' : reset,
+            'read_mb' : (end_bytes - start_bytes) / 2**20 if start_bytes is not None and end_bytes is not None else None,
+        }
+        with _profile['lock']:
+            _profile['records'].append(record)
+
+def collect():
+    """
+    Take the records of the current process, so that workers can return them to the main process
+
+    Returns
+    ----------
+    records (list): stage records measured since the last call
+    """
+    with _profile['lock']:
+        records, _profile['records'] = _profile['records'], []
+    return records
+
+def extend(records):
+    """
+    Add stage records returned by worker processes to those of the current process
+
+    Parameters
+    ----------
+    records (list): stage records, as returned by collect
+    """
+    with _profile['lock']:
+        _profile['records'].extend(records or [])
+
+def summarize(records):
+    """
+    Aggregate stage records by stage
+
+    Parameters
+    ----------
+    records (list): stage records, as returned by collect
+
+    Returns
+    ----------
+    summary (pd.DataFrame): count, total and mean wall time, total CPU time,
+    maximum peak resident set size and total bytes read of each stage
+    """
+    records = pd.DataFrame(records)
+    if records.empty:
+        return records
+
+    summary = records.groupby('stage', sort=False).agg(
+                    count = ('wall_s', 'size'),
+                    wall_s = ('wall_s', 'sum'),
+                    mean_wall_s = ('wall_s', 'mean'),
+                    cpu_s = ('cpu_s', 'sum'),
+                    children_cpu_s = ('children_cpu_s', 'sum'),
+                    peak_rss_mb = ('peak_rss_mb', 'max'),
+                    read_mb = ('read_mb', 'sum'),
+    )
+
+    return summary
+
+def write_profile(directory, script, metadata = {}):
+    """
+    Write the stage records of the current run as JSON and CSV, named after the script and start time
+
+    Parameters
+    ----------
+    directory (str): directory to save profiles to
+    script (str): name of the profiled script
+    metadata (dict): additional JSON serializable run information, e.g. arguments
+
+    Returns
+    ----------
+    summary (pd.DataFrame): per stage summary, as returned by summarize
+    """
+    records = collect()
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, f'{script}_{time.strftime("%Y%m%d-%H%M%S")}_{os.getpid()}_profile')
+    summary = summarize(records)
+
+    with open(f'{stem}.json', 'w') as savefile:
+        json.dump({
+            'script' : script,
+            'argv' : sys.argv,
+            **metadata,
+            'records' : records,
+            'summary' : json.loads(summary.to_json(orient='index')) if not(summary.empty) else {}
+        }, savefile, default=str)
+    pd.DataFrame(records).to_csv(f'{stem}.csv', index=False)
+
+    return summary
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"functions for extracting denoised parcel time series from functional images"
+
+import numpy as np
+from scipy import sparse
+from nilearn import signal
+from nilearn.image import resample_to_img
+
+__all__ = [
+'get_label_matrix',
+'extract_signals',
+'clean_signals'
+]
+
+def get_label_matrix(atlases, img):
+    """
+    Build a sparse averaging matrix mapping image voxels to the regions of
+    one or several atlases, atlases being resampled to the image grid
+
+    Parameters
+    ----------
+    atlases (list): atlas images (Nifti1Image) with integer labels
+    img (Nifti1Image): functional image defining the voxel grid
+
+    Returns
+    ----------
+    label_matrix (csr_matrix): regions x voxels matrix, each row averaging the voxels of one region
+    regions (list): atlas labels of the rows belonging to each atlas
+    """
+    rows, regions = [], []
+
+    for atlas in atlases:
+        labels = np.asarray(resample_to_img(atlas, img, interpolation='nearest').dataobj).ravel()
+        atlas_regions, index, counts = np.unique(labels, return_inverse=True, return_counts=True)
+
+        # one row per non-background label, with weight 1/n on each of its n voxels
+
+        keep = atlas_regions != 0
+        row = np.cumsum(keep) - 1
+        voxels = np.flatnonzero(keep[index])
+        rows.append(sparse.csr_matrix(
+                        (1. / counts[index[voxels]], (row[index[voxels]], voxels)),
+                        shape = (np.count_nonzero(keep), labels.size)
+        ))
+        regions.append(atlas_regions[keep])
+
+    return sparse.vstack(rows).tocsr(), regions
+
+def extract_signals(img, label_matrix, chunk_size = None):
+    """
+    Average the voxel time series of an image within atlas regions, optionally
+    streaming the image in chunks of timepoints so that peak memory is bounded
+    by the chunk size rather than by the length of the scan
+
+    Parameters
+    ----------
+    img (Nifti1Image): 4D functional image
+    label_matrix (csr_matrix): averaging matrix, as returned by get_label_matrix
+    chunk_size (int): number of timepoints read at a time, None to load the whole image
+
+    Returns
+    ----------
+    signals (np.array): raw region signals, timepoints x regions
+    """
+    n_timepoints = img.shape[-1]
+    if not(chunk_size):
+        return np.asarray(label_matrix @ img.get_fdata().reshape(-1, n_timepoints)).T
+
+    # chunks are read in increasing order through the array proxy, so compressed
+    # files are decompressed once when the file handle is kept open
+
+    signals = np.empty((n_timepoints, label_matrix.shape[0]))
+    for start in range(0, n_timepoints, chunk_size):
+        chunk = np.asarray(img.dataobj[..., start:start + chunk_size], dtype=np.float64)
+        signals[start:start + chunk_size] = (label_matrix @ chunk.reshape(-1, chunk.shape[-1])).T
+
+    return signals
+
+def clean_signals(signals, confounds = None, sample_mask = None, standardize = True):
+    """
+    Regress confounds out of region signals and standardize them, as done by
+    NiftiLabelsMasker after region averaging
+
+    Parameters
+    ----------
+    signals (np.array): raw region signals, timepoints x regions
+    confounds (pd.DataFrame): confound regressors, as returned by load_confounds_strategy
+    sample_mask (np.array): indices of timepoints to keep
+    standardize (bool): whether to z-score the cleaned signals
+
+    Returns
+    ----------
+    signals (np.array): cleaned region signals
+    """
+    return signal.clean(
+                    signals,
+                    detrend = False,
+                    standardize = standardize,
+                    standardize_confounds = True,
+                    confounds = confounds,
+                    sample_mask = sample_mask,
+                    t_r = None,
+                    low_pass = None,
+                    high_pass = None
+    )
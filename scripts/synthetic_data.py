@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+"functions for generating synthetic fmriprep-like derivatives and connectomes for benchmarking"
+
+import argparse
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from format_data import get_format_file
+from feature_store import save_feature_store
+
+__all__ = [
+'make_atlas',
+'make_derivatives',
+'make_connectomes'
+]
+
+DIAGNOSES = ['CONTROL', 'SCHZ', 'BIPOLAR', 'ADHD']
+BOLD_SUFFIX = 'space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz'
+AFFINE = np.diag([4., 4., 4., 1.])
+
+def make_atlas(shape = (40, 48, 40), n_regions = 64, seed = None):
+    """
+    Generate a label image of contiguous parcels, each voxel of an
+    ellipsoidal brain mask being assigned to its nearest of n random centers
+
+    Parameters
+    ----------
+    shape (tuple): dimensions of the volume
+    n_regions (int): number of parcels
+    seed (int): seed of parcel centers
+
+    Returns
+    ----------
+    atlas (Nifti1Image): atlas with labels 1 to n_regions, 0 outside the brain
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(s) for s in shape], indexing='ij'), axis=-1).reshape(-1, 3)
+    center = (np.asarray(shape) - 1) / 2.
+    brain = (((grid - center) / (0.45 * np.asarray(shape))) ** 2).sum(axis=1) <= 1
+
+    centers = grid[brain][rng.choice(np.count_nonzero(brain), n_regions, replace=False)]
+    labels = np.zeros(len(grid), dtype=np.int16)
+    distances = ((grid[brain][:, None, :] - centers[None]) ** 2).sum(axis=-1)
+    labels[brain] = np.argmin(distances, axis=1) + 1
+
+    return nib.Nifti1Image(labels.reshape(shape), AFFINE)
+
+def make_subject(path, subname, atlas, diagnosis, n_timepoints, rng):
+    """
+    Write the preprocessed BOLD image, confounds and sidecars of one subject,
+    regions of the diagnosis sharing a common signal so that classes differ in connectivity
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory
+    subname (str): subject identifier (sub-XXX)
+    atlas (Nifti1Image): atlas defining regions
+    diagnosis (int): index of diagnosis in DIAGNOSES
+    n_timepoints (int): number of volumes
+    rng (Generator): random number generator
+    """
+    func = os.path.join(path, subname, 'func')
+    os.makedirs(func, exist_ok=True)
+    prefix = os.path.join(func, f'{subname}_task-rest')
+
+    labels = np.asarray(atlas.dataobj).ravel()
+    n_regions = labels.max()
+    signals = rng.standard_normal((n_timepoints, n_regions + 1))
+    block = np.arange(n_regions) % len(DIAGNOSES) == diagnosis
+    signals[:, 1:][:, block] += rng.standard_normal((n_timepoints, 1))
+    signals[:, 0] = 0
+
+    data = 100. + signals[:, labels].T + 0.5 * rng.standard_normal((len(labels), n_timepoints))
+    nib.save(nib.Nifti1Image(data.reshape(*atlas.shape, n_timepoints).astype(np.float32), AFFINE), f'{prefix}_{BOLD_SUFFIX}')
+    with open(f'{prefix}_{BOLD_SUFFIX.split(".")[0]}.json', 'w') as savefile:
+        json.dump({'RepetitionTime' : 2.0, 'TaskName' : 'rest'}, savefile)
+
+    confounds = {column : rng.standard_normal(n_timepoints) for column in ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z', 'csf', 'white_matter', 'global_signal']}
+    for k in range(3):
+        confounds[f'cosine{k:02d}'] = np.cos(np.pi * (k + 1) * (np.arange(n_timepoints) + 0.5) / n_timepoints)
+    pd.DataFrame(confounds).to_csv(f'{prefix}_desc-confounds_timeseries.tsv', sep='\t', index=False)
+    with open(f'{prefix}_desc-confounds_timeseries.json', 'w') as savefile:
+        json.dump({}, savefile)
+
+def make_participants(path, n_subjects, rng):
+    """
+    Write participants.tsv with diagnoses cycling through DIAGNOSES
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory
+    n_subjects (int): number of subjects
+    rng (Generator): random number generator
+
+    Returns
+    ----------
+    participants (pd.DataFrame): participant_id, diagnosis, age and gender of each subject
+    """
+    participants = pd.DataFrame({
+                'participant_id' : [f'sub-{10000 + s}' for s in range(n_subjects)],
+                'diagnosis' : [DIAGNOSES[s % len(DIAGNOSES)] for s in range(n_subjects)],
+                'age' : rng.integers(20, 50, n_subjects),
+                'gender' : ['MF'[s % 2] for s in range(n_subjects)],
+                })
+    participants.to_csv(os.path.join(path, 'participants.tsv'), sep='\t', index=False)
+
+    return participants
+
+def make_derivatives(path, n_subjects = 20, n_timepoints = 150, shape = (40, 48, 40), n_regions = 64, seed = None):
+    """
+    Generate an fmriprep-like derivatives directory with BOLD images,
+    confounds, participants.tsv, format_file.json and an atlas
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory to create
+    n_subjects (int): number of subjects
+    n_timepoints (int): number of volumes per scan
+    shape (tuple): dimensions of each volume
+    n_regions (int): number of atlas regions
+    seed (int): seed of all generated data
+
+    Returns
+    ----------
+    atlas_path (str): path to the generated atlas
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+
+    atlas = make_atlas(shape, n_regions, seed)
+    atlas_path = os.path.join(path, 'atlas.nii.gz')
+    nib.save(atlas, atlas_path)
+
+    participants = make_participants(path, n_subjects, rng)
+    for subname, diagnosis in zip(participants['participant_id'], participants['diagnosis']):
+        make_subject(path, subname, atlas, DIAGNOSES.index(diagnosis), n_timepoints, rng)
+
+    get_format_file(path, BOLD_SUFFIX)
+
+    return atlas_path
+
+def make_connectomes(path, n_subjects = 500, n_regions = 64, seed = None):
+    """
+    Generate a connectome-only derivatives directory with vectorized
+    correlation connectomes, a feature store and format_file.json
+
+    Parameters
+    ----------
+    path (str): path to derivatives directory to create
+    n_subjects (int): number of subjects
+    n_regions (int): number of regions of each connectome
+    seed (int): seed of all generated data
+    """
+    rng = np.random.default_rng(seed)
+    save_to = os.path.join(path, 'connectomes')
+    os.makedirs(save_to, exist_ok=True)
+
+    participants = make_participants(path, n_subjects, rng)
+    n_edges = n_regions * (n_regions - 1) // 2
+    connectomes = []
+    for subname, diagnosis in zip(participants['participant_id'], participants['diagnosis']):
+        edges = 0.3 * rng.standard_normal(n_edges)
+        edges[np.arange(n_edges) % len(DIAGNOSES) == DIAGNOSES.index(diagnosis)] += 0.2
+        connectomes.append(os.path.join(save_to, f'{subname}_rest_connectome.npy'))
+        np.save(connectomes[-1], np.tanh(edges))
+
+    with open(os.path.join(path, 'format_file.json'), 'w') as savefile:
+        json.dump({
+            'func' : [[] for _ in range(n_subjects)],
+            'phenotypic' : participants.astype(str).values.tolist(),
+            'subject_order' : participants['participant_id'].tolist(),
+            }, savefile)
+    save_feature_store(path, 'rest', participants['participant_id'].tolist(), connectomes, metadata = {'connectivity_measure' : 'correlation'})
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help='Path to derivatives directory to create')
+    parser.add_argument('--connectomes_only', action='store_true', help='Generate connectomes and a feature store instead of BOLD images')
+    parser.add_argument('--n_subjects', type=int, help='Number of subjects', default=20)
+    parser.add_argument('--n_timepoints', type=int, help='Number of volumes per scan', default=150)
+    parser.add_argument('--shape', type=int, nargs=3, help='Dimensions of each volume', default=[40, 48, 40])
+    parser.add_argument('--n_regions', type=int, help='Number of atlas regions', default=64)
+    parser.add_argument('--seed', type=int, help='Seed of generated data', default=0)
+    args = parser.parse_args()
+
+    if args.connectomes_only:
+        make_connectomes(args.path, args.n_subjects, args.n_regions, args.seed)
+    else:
+        make_derivatives(args.path, args.n_subjects, args.n_timepoints, tuple(args.shape), args.n_regions, args.seed)
@@ -0,0 +1,66 @@
+"regression tests of the svm estimators and Gram searches against sklearn"
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.model_selection import GridSearchCV, StratifiedKFold
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC
+from synthetic_data import make_connectomes
+from feature_store import load_feature_store, read_features
+from estimators import PrimalSVC, PrecomputedSVC, fit_gram_search
+
+@pytest.fixture(scope='module')
+def connectomes(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('derivatives'))
+    make_connectomes(path, n_subjects=80, n_regions=16, seed=0)
+    X = StandardScaler().fit_transform(read_features(load_feature_store(path)))
+    y = pd.read_csv(os.path.join(path, 'participants.tsv'), sep='\t')['diagnosis'].to_numpy()
+    return X, y
+
+@pytest.mark.parametrize('kernel', ['linear', 'rbf', 'poly', 'sigmoid'])
+def test_precomputed_svc(connectomes, kernel):
+    X, y = connectomes
+    expected = SVC(kernel=kernel, C=0.5).fit(X[:60], y[:60])
+    svc = PrecomputedSVC(kernel=kernel, C=0.5).fit(X[:60], y[:60])
+
+    np.testing.assert_array_equal(svc.predict(X[60:]), expected.predict(X[60:]))
+    np.testing.assert_allclose(svc.decision_function(X[60:]), expected.decision_function(X[60:]), rtol=1e-6, atol=1e-8)
+    if kernel == 'linear':
+        np.testing.assert_allclose(svc.coef_, expected.coef_, rtol=1e-6, atol=1e-10)
+
+def test_precomputed_svc_binary(connectomes):
+    X, y = connectomes
+    keep = np.isin(y, ['CONTROL', 'SCHZ'])
+    expected = SVC(kernel='linear').fit(X[keep], y[keep])
+    svc = PrecomputedSVC(kernel='linear').fit(X[keep], y[keep])
+
+    np.testing.assert_allclose(svc.coef_, expected.coef_, rtol=1e-6, atol=1e-10)
+    np.testing.assert_allclose(svc.decision_function(X), expected.decision_function(X), rtol=1e-6, atol=1e-8)
+
+@pytest.mark.parametrize('n_classes', [2, 4])
+def test_primal_svc_layout(connectomes, n_classes):
+    # primal solvers approximate libsvm, their weights only being expected to point the same way
+    X, y = connectomes
+    keep = np.isin(y, np.unique(y)[:n_classes])
+    expected = SVC(kernel='linear', C=0.01).fit(X[keep], y[keep])
+    svc = PrimalSVC(C=0.01, max_iter=10000, random_state=0).fit(X[keep], y[keep])
+
+    np.testing.assert_array_equal(svc.classes_, expected.classes_)
+    assert svc.coef_.shape == expected.coef_.shape
+    for ours, theirs in zip(svc.coef_, expected.coef_):
+        assert np.corrcoef(ours, theirs)[0, 1] > 0.9
+    assert np.mean(svc.predict(X[keep]) == expected.predict(X[keep])) > 0.9
+
+def test_fit_gram_search(connectomes):
+    X, y = connectomes
+    param_grid = [{'svc__kernel' : ['linear'], 'svc__C' : [0.01, 1.]}, {'svc__kernel' : ['rbf'], 'svc__C' : [0.1, 10.], 'svc__gamma' : ['scale', 1e-3]}]
+    cv = list(StratifiedKFold(n_splits=4).split(X, y))
+    expected = pd.DataFrame(GridSearchCV(Pipeline([('scaler', StandardScaler()), ('svc', SVC())]), param_grid, cv=cv, return_train_score=True).fit(X, y).cv_results_)
+    history = fit_gram_search(X, y, param_grid, cv)
+
+    assert history['params'].tolist() == expected['params'].tolist()
+    for column in ['mean_test_score', 'mean_train_score', 'rank_test_score', *[f'split{k}_test_score' for k in range(len(cv))]]:
+        np.testing.assert_allclose(history[column], expected[column])
@@ -0,0 +1,73 @@
+"tests of the pipeline task graph run in process on synthetic derivatives"
+
+import os
+import json
+import pytest
+from synthetic_data import make_derivatives
+from pipeline import SyncExecutor, get_tasks, run_graph
+
+class RecordingExecutor(SyncExecutor):
+    """
+    Executor recording the arguments of each task it runs
+    """
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, function, script, args, in_process):
+        self.submitted.append(tuple(args))
+        return super().submit(function, script, args, in_process)
+
+@pytest.fixture
+def graph(tmp_path):
+    path = str(tmp_path / 'data' / 'derivatives')
+    atlas = make_derivatives(path, n_subjects=40, n_timepoints=40, shape=(10, 12, 10), n_regions=8, seed=0)
+    work_dir = os.path.join(path, 'pipeline')
+    tasks = get_tasks(path, [atlas], n_shards=2, fit_args=['--seed', 0], work_dir=work_dir)
+    return path, tasks, os.path.join(work_dir, 'state.json')
+
+def run(tasks, state_path):
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as o:
+            state = json.load(o)
+    executor = RecordingExecutor()
+    failed = run_graph(tasks, executor, state, state_path, in_process=True, verbosity=0)
+    names = {tuple(t.args) : t.name for t in tasks}
+    return failed, [names[args] for args in executor.submitted]
+
+def test_run_graph(graph):
+    path, tasks, state_path = graph
+    assert [t.name for t in tasks] == ['timeseries-0', 'timeseries-1', 'connectivity', 'fit']
+
+    # a failed shard skips its dependents
+
+    bold = sorted(f for f in tasks[1].inputs if f.endswith('bold.nii.gz'))[0]
+    os.rename(bold, f'{bold}.moved')
+    failed, ran = run(tasks, state_path)
+    assert sorted(failed) == ['connectivity', 'fit', 'timeseries-1']
+    assert failed['connectivity'] == 'Dependency timeseries-1 failed'
+    assert ran == ['timeseries-0', 'timeseries-1']
+
+    # only the failed task reruns, followed by the dependents it ran again for
+
+    os.rename(f'{bold}.moved', bold)
+    failed, ran = run(tasks, state_path)
+    assert failed == {}
+    assert ran == ['timeseries-1', 'connectivity', 'fit']
+    assert os.path.exists(os.path.join(os.path.dirname(os.path.dirname(path)), 'results', 'svc_rest_weights.npy'))
+
+    # nothing runs once every task succeeded
+
+    failed, ran = run(tasks, state_path)
+    assert failed == {}
+    assert ran == []
+
+def test_plots_tasks(graph):
+    path, tasks, _ = graph
+    atlases = [os.path.join(path, 'atlas.nii.gz'), os.path.join(path, 'atlas2.nii.gz')]
+    tasks = {t.name : t for t in get_tasks(path, atlases, plots=True, results='results', work_dir=os.path.join(path, 'pipeline'))}
+
+    for name, atlas in zip(['atlas', 'atlas2'], atlases):
+        assert tasks[f'plots-{name}'].deps == [f'fit-{name}']
+        assert tasks[f'plots-{name}'].args[tasks[f'plots-{name}'].args.index('--atlas') + 1] == atlas
+        assert tasks[f'plots-{name}'].args[tasks[f'plots-{name}'].args.index('--namespace') + 1] == name
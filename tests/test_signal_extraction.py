@@ -0,0 +1,34 @@
+"regression tests of streamed region signal extraction against nilearn's NiftiLabelsMasker"
+
+import os
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import pytest
+from nilearn.maskers import NiftiLabelsMasker
+from synthetic_data import make_atlas
+from signal_extraction import get_label_matrix, extract_signals, clean_signals
+
+@pytest.fixture(scope='module')
+def scan(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    atlas = make_atlas((12, 14, 12), n_regions=10, seed=0)
+    data = rng.standard_normal((*atlas.shape, 50)).astype(np.float32)
+    path = os.path.join(str(tmp_path_factory.mktemp('func')), 'bold.nii.gz')
+    nib.save(nib.Nifti1Image(data, atlas.affine), path)
+    confounds = pd.DataFrame(rng.standard_normal((50, 3)), columns=['a', 'b', 'c'])
+    return atlas, path, confounds
+
+@pytest.mark.parametrize('chunk_size', [None, 7])
+@pytest.mark.parametrize('sample_mask', [None, np.arange(5, 50)])
+def test_extract_signals(scan, chunk_size, sample_mask):
+    atlas, path, confounds = scan
+    expected = NiftiLabelsMasker(atlas, standardize=True).fit_transform(path, confounds=confounds, sample_mask=sample_mask)
+
+    img = nib.load(path, keep_file_open=True) if chunk_size else nib.load(path)
+    label_matrix, regions = get_label_matrix([atlas], img)
+    signals = clean_signals(extract_signals(img, label_matrix, chunk_size), confounds, sample_mask)
+
+    np.testing.assert_array_equal(regions[0], np.arange(1, 11))
+    # the masker averages float32 images in single precision, region signals here being averaged in double precision
+    np.testing.assert_allclose(signals, expected, atol=1e-4)